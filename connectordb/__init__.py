@@ -4,7 +4,9 @@ To install the client::
 
     pip install connectordb
 
-Another optional requirement is python-apsw.
+Another optional requirement is python-apsw, which is used by the logger. Installing numpy
+enables the columnar data analysis tools, and pandas or pyarrow enable converting data to DataFrames
+or Arrow tables.
 
 
 The client enables quick usage of the database for IoT stuff and data analysis::
@@ -38,7 +40,10 @@ to allow public access::
 from __future__ import absolute_import
 
 from ._connectordb import *
-from ._connection import AuthenticationError, ServerError
+from ._connection import AuthenticationError, ServerError, PayloadTooLargeError
 from ._datapointarray import DatapointArray
+from ._upload import UploadSession
+from ._stats import Statistics
+from ._sorter import DatapointSorter
 
 __version__ = "0.3.5"
@@ -0,0 +1,313 @@
+from __future__ import absolute_import
+
+# This module uses the async/await syntax, so it requires python 3.5 or newer, as well as
+# the websockets package. It is only imported once an async subscription is made.
+
+import asyncio
+import collections
+import json
+import logging
+import random
+
+import websockets
+
+from ._datapointarray import DatapointArray
+from ._websocket import WebsocketHandler
+
+# Put into a subscription's queue when the subscription ends
+_CLOSED = object()
+
+
+async def _connect(url, headers):
+    try:
+        from websockets.asyncio.client import connect
+        return await connect(url, additional_headers=headers)
+    except ImportError:
+        # websockets < 13
+        return await websockets.connect(url, extra_headers=headers)
+
+
+class AsyncSubscription(object):
+    """AsyncSubscription is an async iterator over the datapoints sent by ConnectorDB for a stream subscription.
+    It is returned by Stream.subscribe_async, and subscribes once iteration starts. Each message is a
+    DatapointArray of the datapoints that were inserted::
+
+        async with stream.subscribe_async(downlink=True, transform="if last") as sub:
+            async for data in sub:
+                await set_light(data[-1]["d"])
+                await sub.acknowledge()
+
+    Messages are queued until they are read. If the subscription was given a maxsize, the oldest message
+    is dropped when the queue is full. Iteration ends once the subscription is closed.
+    """
+
+    def __init__(self, handler, stream, transform="", maxsize=0):
+        self.handler = handler
+        self.stream = stream
+        self.transform = transform
+        self.maxsize = maxsize
+        self.queue = None
+        self.last = None
+        self.subscribed = False
+        self.closed = False
+
+    @property
+    def key(self):
+        return self.stream + ":" + self.transform
+
+    async def subscribe(self):
+        """Subscribes to the stream. This is done automatically when iteration starts."""
+        if self.subscribed:
+            return
+        if self.closed:
+            raise ValueError("The subscription to %s is closed" % (self.stream, ))
+        self.queue = asyncio.Queue()
+        self.subscribed = True
+        try:
+            await self.handler.subscribe(self)
+        except Exception:
+            self.subscribed = False
+            raise
+
+    def _put(self, data):
+        """Called by the handler with each message's data"""
+        if self.maxsize > 0 and self.queue.qsize() >= self.maxsize:
+            logging.warning("ConnectorDB:WS: subscription to %s is full - dropping the oldest message", self.stream)
+            self.queue.get_nowait()
+        self.queue.put_nowait(data)
+
+    def _end(self):
+        self.closed = True
+        if self.queue is not None:
+            self.queue.put_nowait(_CLOSED)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.subscribed:
+            if self.closed:
+                raise StopAsyncIteration
+            await self.subscribe()
+        data = await self.queue.get()
+        if data is _CLOSED:
+            # Leave the marker for anyone else waiting on the subscription
+            self.queue.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        self.last = data
+        return DatapointArray(data)
+
+    async def acknowledge(self, data=None):
+        """Acknowledges datapoints of a downlink subscription, inserting them into the stream. Without data,
+        the most recent message is acknowledged, which is the same as returning True from a callback of
+        Stream.subscribe"""
+        if not self.stream.endswith("/downlink"):
+            raise ValueError("Only downlink subscriptions can be acknowledged")
+        if data is None:
+            data = self.last
+        if data is not None:
+            await self.handler.insert(self.stream[:-len("/downlink")], list(data))
+
+    async def close(self):
+        """Unsubscribes, ending the iteration"""
+        if self.subscribed and not self.closed:
+            await self.handler.unsubscribe(self)
+        self._end()
+
+    async def __aenter__(self):
+        await self.subscribe()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncWebsocketHandler(object):
+    """AsyncWebsocketHandler is the asyncio version of WebsocketHandler. The websocket connection and the
+    dispatching of messages to subscriptions run as a task on the event loop, so no threads are used,
+    and subscribers get messages through AsyncSubscription iterators rather than callbacks.
+
+    Just like WebsocketHandler, the handler reconnects (with the same backoff) when the connection is lost,
+    and resubscribes to all subscriptions. Keepalive pings are handled by the websockets package.
+    The handler uses the URL and authentication of the connection's WebsocketHandler.
+    """
+    reconnect_time_max_seconds = WebsocketHandler.reconnect_time_max_seconds
+    reconnect_time_backoff_multiplier = WebsocketHandler.reconnect_time_backoff_multiplier
+    reconnect_time_starting_seconds = WebsocketHandler.reconnect_time_starting_seconds
+
+    def __init__(self, wshandler):
+        self.wshandler = wshandler
+        self.ws = None
+        self.task = None
+        self.lock = None
+        self.loop = None  # The event loop that the lock, task and websocket belong to
+        self.subscriptions = {}
+        self.reconnect_time = self.reconnect_time_starting_seconds
+
+        # Messages that don't come from a stream are error messages, such as a failed insert
+        self.errors = collections.deque(maxlen=100)
+        self.onerror = None
+
+    @property
+    def status(self):
+        return "connected" if self.ws is not None else "disconnected"
+
+    async def __open(self):
+        headers = [tuple(h.split(": ", 1)) for h in self.wshandler.headers]
+        return await _connect(self.wshandler.ws_url, headers)
+
+    async def connect(self):
+        """Connects to the websocket, if not already connected. Raises an exception if the connection fails."""
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            # The handler was used on another event loop (such as an earlier asyncio.run), which has ended.
+            # Its lock, task, websocket and subscriptions can't be used on this one.
+            self.__reset()
+            self.loop = loop
+        elif self.task is not None and self.task.done():
+            if not self.task.cancelled() and self.task.exception() is not None:
+                logging.error("ConnectorDB:WS: Websocket task failed: %s", str(self.task.exception()))
+            self.task = None
+            self.ws = None
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.task is not None:
+                return
+            self.ws = await self.__open()
+            for sub in list(self.subscriptions.values()):
+                logging.debug("Resubscribing to %s", sub[0].key)
+                await self.send({"cmd": "subscribe", "arg": sub[0].stream, "transform": sub[0].transform})
+            self.task = asyncio.ensure_future(self.__run())
+
+    def __reset(self):
+        self.lock = None
+        self.task = None
+        self.ws = None
+        subscriptions = self.subscriptions
+        self.subscriptions = {}
+        for subs in subscriptions.values():
+            for sub in subs:
+                # The subscription's queue belongs to the old loop too, so it is ended without using the queue
+                sub.subscribed = False
+                sub.closed = True
+
+    async def close(self):
+        """Closes the websocket, ending all subscriptions"""
+        task, ws = self.task, self.ws
+        self.task = None
+        self.ws = None
+        if task is not None:
+            task.cancel()
+        if ws is not None:
+            await ws.close()
+        subscriptions = self.subscriptions
+        self.subscriptions = {}
+        for subs in subscriptions.values():
+            for sub in subs:
+                sub._end()
+
+    async def send(self, cmd):
+        if self.ws is None:
+            raise ConnectionError("The ConnectorDB websocket is not connected")
+        await self.ws.send(json.dumps(cmd))
+
+    async def insert(self, stream, data):
+        """Insert the given datapoints into the stream"""
+        await self.send({"cmd": "insert", "arg": stream, "d": data})
+
+    async def subscribe(self, sub):
+        """Adds the given AsyncSubscription, subscribing to its stream if it is the first one for the stream"""
+        await self.connect()
+        if sub.key in self.subscriptions:
+            self.subscriptions[sub.key].append(sub)
+            return
+        logging.debug("Subscribing to %s", sub.stream)
+        self.subscriptions[sub.key] = [sub]
+        await self.send({"cmd": "subscribe", "arg": sub.stream, "transform": sub.transform})
+
+    async def unsubscribe(self, sub):
+        """Removes the given AsyncSubscription, and closes the websocket once there are no subscriptions"""
+        subs = self.subscriptions.get(sub.key, [])
+        if sub in subs:
+            subs.remove(sub)
+        if len(subs) > 0:
+            return
+        self.subscriptions.pop(sub.key, None)
+        if len(self.subscriptions) == 0:
+            await self.close()
+        elif self.ws is not None:
+            logging.debug("Unsubscribing from %s", sub.stream)
+            await self.send({"cmd": "unsubscribe", "arg": sub.stream, "transform": sub.transform})
+
+    def __on_message(self, msg):
+        msg = json.loads(msg)
+        if "stream" not in msg:
+            logging.warning("ConnectorDB:WS: Server error: %s", msg)
+            self.errors.append(msg)
+            if self.onerror is not None:
+                self.onerror(msg)
+            return
+        logging.debug("ConnectorDB:WS: Msg '%s'", msg["stream"])
+
+        key = msg["stream"] + ":" + msg.get("transform", "")
+        if key not in self.subscriptions:
+            logging.warning("ConnectorDB:WS: Msg '%s' not subscribed! Subscriptions: %s", msg["stream"],
+                            list(self.subscriptions.keys()))
+            return
+        for sub in self.subscriptions[key]:
+            sub._put(msg["data"])
+
+    def __backoff(self):
+        """Returns the time to wait before the next reconnect attempt, using the same backoff as WebsocketHandler"""
+        self.reconnect_time *= self.reconnect_time_backoff_multiplier
+        self.reconnect_time = min(self.reconnect_time, self.reconnect_time_max_seconds)
+        self.reconnect_time *= 1 + random.uniform(-0.2, 0.2)
+        self.reconnect_time = max(self.reconnect_time, self.reconnect_time_starting_seconds)
+        return self.reconnect_time
+
+    async def __run(self):
+        """Reads messages from the websocket, reconnecting whenever the connection is lost. Errors in handling
+        a message (such as invalid json, or an exception in onerror) are logged, and don't stop the handler."""
+        while True:
+            try:
+                async for msg in self.ws:
+                    try:
+                        self.__on_message(msg)
+                    except Exception:
+                        logging.exception("ConnectorDB:WS: Failed to handle message")
+            except websockets.ConnectionClosed:
+                pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("ConnectorDB:WS: Websocket failed")
+                await self.__close_ws()
+            logging.debug("ConnectorDB:WS: Websocket closed")
+            self.ws = None
+
+            while self.ws is None:
+                wait = self.__backoff()
+                logging.warning("ConnectorDB:WS: Attempting to reconnect in %fs", wait)
+                await asyncio.sleep(wait)
+                try:
+                    self.ws = await self.__open()
+                    for sub in list(self.subscriptions.values()):
+                        logging.debug("Resubscribing to %s", sub[0].key)
+                        await self.send({"cmd": "subscribe", "arg": sub[0].stream, "transform": sub[0].transform})
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.debug("ConnectorDB:WS: Reconnect failed: %s", str(e))
+                    await self.__close_ws()
+                    self.ws = None
+
+            self.reconnect_time /= self.reconnect_time_backoff_multiplier
+
+    async def __close_ws(self):
+        """Closes the current websocket after an error, ignoring any further errors"""
+        if self.ws is not None:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
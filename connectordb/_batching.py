@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+import collections
+import itertools
+import json
+import logging
+import threading
+
+# The number of datapoints in the first insert request, before the size of datapoints is known
+DATAPOINT_INSERT_LIMIT = 5000
+
+
+class InsertBatcher(object):
+    """InsertBatcher decides how many datapoints are sent to ConnectorDB in each insert request.
+    Rather than using a fixed number of datapoints, it aims for requests of a given encoded size,
+    so that large JSON datapoints don't go over the server's request size limit, and small numeric
+    datapoints don't waste round trips.
+
+    The target size adapts to the measured latency of the requests: it grows while requests
+    finish quickly, and shrinks when they are slow. If the server rejects a request as too large,
+    the maximum request size is lowered below the rejected size.
+
+    Each DatabaseConnection has its own batcher, so the learned sizes are shared by all inserts
+    made through the connection. The most recent batches are available in `history` as tuples of
+    (number of datapoints, bytes, seconds)::
+
+        cdb["mystream"].insert_array(datapoints)
+        print(cdb.db.batcher.history)
+    """
+    """The request size in bytes that batches start out targeting"""
+    target_bytes_starting = 256 * 1024
+    """The smallest request size that the batcher will target"""
+    target_bytes_min = 16 * 1024
+    """Requests that take longer than this many seconds make the batcher target smaller requests"""
+    target_latency_seconds = 1.0
+    """The maximum number of datapoints in a single request"""
+    max_count = 100000
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, history=100):
+        self.max_bytes = max_bytes
+        self.target_bytes = min(self.target_bytes_starting, max_bytes)
+        # The average encoded size of a datapoint, which is unknown until the first batch is encoded
+        self.datapoint_bytes = None
+        self.history = collections.deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def count(self):
+        """Returns the number of datapoints that the next batch should contain"""
+        with self.lock:
+            if self.datapoint_bytes is None:
+                return DATAPOINT_INSERT_LIMIT
+            n = int(self.target_bytes / self.datapoint_bytes)
+        return max(1, min(n, self.max_count))
+
+    def encode(self, chunk):
+        """Encodes the given list of datapoints, returning a list of (chunk, body) tuples.
+        If the encoded chunk is above the maximum request size, it is split up."""
+        body = json.dumps(chunk)
+        with self.lock:
+            size = float(len(body)) / len(chunk)
+            if self.datapoint_bytes is None:
+                self.datapoint_bytes = size
+            else:
+                self.datapoint_bytes = 0.7 * self.datapoint_bytes + 0.3 * size
+            max_bytes = self.max_bytes
+        if len(body) <= max_bytes or len(chunk) == 1:
+            return [(chunk, body)]
+        half = len(chunk) // 2
+        return self.encode(chunk[:half]) + self.encode(chunk[half:])
+
+    def chunks(self, datapoints):
+        """Splits the given iterable of datapoints into encoded batches, yielding (chunk, body) tuples.
+        The datapoints are consumed from a single iterator, so neither the input nor its remainder
+        is ever copied, and generators work just as well as lists."""
+        it = iter(datapoints)
+        while True:
+            chunk = list(itertools.islice(it, self.count()))
+            if len(chunk) == 0:
+                return
+            for batch in self.encode(chunk):
+                yield batch
+
+    def sent(self, count, nbytes, seconds):
+        """Records a successful insert request, adapting the target request size to its latency"""
+        with self.lock:
+            self.history.append((count, nbytes, seconds))
+            if nbytes >= self.target_bytes / 2:
+                if seconds < self.target_latency_seconds / 2:
+                    self.target_bytes = min(2 * self.target_bytes, self.max_bytes)
+                elif seconds > self.target_latency_seconds:
+                    self.target_bytes = max(self.target_bytes / 2, self.target_bytes_min)
+        logging.debug("ConnectorDB: inserted %i datapoints (%i bytes) in %fs", count, nbytes, seconds)
+
+    def rejected(self, nbytes):
+        """Records that the server rejected a request of the given size as too large"""
+        with self.lock:
+            self.max_bytes = min(self.max_bytes, int(nbytes * 0.75))
+            self.target_bytes = min(self.target_bytes, self.max_bytes)
+        logging.warning("ConnectorDB: insert of %i bytes was too large. Limiting inserts to %i bytes",
+                        nbytes, self.max_bytes)
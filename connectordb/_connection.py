@@ -12,6 +12,7 @@ from requests.auth import HTTPBasicAuth
 import json
 
 from ._websocket import WebsocketHandler
+from ._batching import InsertBatcher
 
 # The subpath to the Create Read Update Delete portion of the API
 CRUD_PATH = "crud/"
@@ -20,18 +21,27 @@ CRUD_PATH = "crud/"
 # Returned when the given credentials are not accepted by the server
 class AuthenticationError(Exception):
 
-    def __init__(self, value):
+    def __init__(self, value, code=None):
         self.value = value
+        # The http status code of the response
+        self.code = code
 
     def __str__(self):
         return repr(self.value)
 
 
+# Returned when the server refuses a request because its body is too large
+class PayloadTooLargeError(AuthenticationError):
+    pass
+
+
 # Returned when the server gives an unhandled error code
 class ServerError(Exception):
 
-    def __init__(self, value):
+    def __init__(self, value, code=None):
         self.value = value
+        # The http status code of the response
+        self.code = code
 
     def __str__(self):
         return repr(self.value)
@@ -53,9 +63,18 @@ class DatabaseConnection(object):
         self.r = Session()
         self.r.headers.update({'content-type': 'application/json'})
 
+        # The batcher learns how many datapoints to send in each insert request
+        self.batcher = InsertBatcher()
+
         # Prepare the websocket
         self.ws = WebsocketHandler(self.url, None)
 
+        # Whether restamped inserts are sent through the websocket when it is connected
+        self.wsinsert_enabled = False
+
+        # The asyncio websocket, which is created on first use
+        self.aws = None
+
         # Set the authentication if any
         self.setauth(user_or_apikey, user_password)
 
@@ -92,25 +111,28 @@ class DatabaseConnection(object):
         """Handles HTTP error codes for the given request
 
         Raises:
+            PayloadTooLargeError if the request body was too large (413)
             AuthenticationError on the appropriate 4** errors
             ServerError if the response is not an ok (2**)
 
         Arguments:
             r -- The request result
         """
+        if r.status_code == 413:
+            raise PayloadTooLargeError("413: Request body too large", 413)
         if r.status_code >= 400 and r.status_code < 500:
             msg = r.json()
             raise AuthenticationError(str(msg["code"]) + ": " + msg["msg"] +
-                                      " (" + msg["ref"] + ")")
+                                      " (" + msg["ref"] + ")", r.status_code)
         elif r.status_code > 300:
             err = None
             try:
                 msg = r.json()
                 err = ServerError(str(msg["code"]) + ": " + msg["msg"] + " (" +
-                                  msg["ref"] + ")")
+                                  msg["ref"] + ")", r.status_code)
             except:
                 raise ServerError(
-                    "Server returned error, but did not give a valid error message")
+                    "Server returned error, but did not give a valid error message", r.status_code)
             raise err
         return r
 
@@ -147,6 +169,13 @@ class DatabaseConnection(object):
                                                     path),
                                             data=json.dumps(data)))
 
+    def insert(self, path, body, restamp=False):
+        """Sends an already json-encoded array of datapoints to the given stream data path. When restamp
+        is True, the datapoints are sent as an update (PUT), which allows the server to rewrite their timestamps"""
+        if restamp:
+            return self.handleresult(self.r.put(urljoin(self.url + CRUD_PATH, path), data=body))
+        return self.handleresult(self.r.post(urljoin(self.url + CRUD_PATH, path), data=body))
+
     def delete(self, path):
         """Send a delete request to the given path of the CRUD API. This deletes the object. Or at least tries to."""
         return self.handleresult(self.r.delete(urljoin(self.url + CRUD_PATH,
@@ -165,6 +194,45 @@ class DatabaseConnection(object):
         """Unsubscribe from the given stream"""
         return self.ws.unsubscribe(stream, transform)
 
+    def wsasync(self):
+        """Returns the AsyncWebsocketHandler of the connection, which runs subscriptions on the asyncio event loop.
+        It uses the same URL and authentication as the websocket. Requires python 3.5+ and the websockets package."""
+        if self.aws is None:
+            from ._asyncws import AsyncWebsocketHandler
+            self.aws = AsyncWebsocketHandler(self.ws)
+        return self.aws
+
+    def wsinsert(self, enabled=True):
+        """Sets whether inserts are sent through the websocket. This avoids the overhead of an http request per
+        insert, and allows sending inserts without waiting for the previous one to finish::
+
+            cdb.db.wsinsert()
+            with cdb["mystream"].writer() as w:
+                ...
+
+        Only inserts with restamp=True (such as those from insert and Stream.writer) go thru the websocket,
+        since the server does not acknowledge websocket inserts, so ordering errors can't be raised.
+        Errors reported by the server are kept in `ws.errors`. Whenever the websocket is not connected, inserts
+        are sent over http. Enabling the websocket inserts connects the websocket, and returns whether it succeeded."""
+        self.wsinsert_enabled = enabled
+        self.ws.persistent = enabled
+        if enabled:
+            return self.ws.connect()
+        return True
+
+    def wsdispatch(self, workers=4, max_queue=1000):
+        """Runs subscription callbacks in a pool of worker threads rather than on the websocket's thread,
+        so that slow callbacks (such as ones writing to a database) don't delay the other subscriptions::
+
+            cdb.db.wsdispatch(8)
+            cdb["mystream"].subscribe(save_to_database)
+
+        The callbacks of each subscription are still called one at a time, in the order that the datapoints
+        were inserted. Passing 0 workers runs callbacks on the websocket's thread again (the default).
+        At most max_queue datapoint messages wait for each subscription's callback, after which the oldest
+        are dropped (see WebsocketHandler.dispatch)."""
+        self.ws.dispatch(workers, max_queue)
+
     def wsdisconnect(self):
         """Disconnects the websocket"""
         self.ws.disconnect()
@@ -3,6 +3,70 @@ from __future__ import absolute_import
 import datetime
 import json
 import os.path
+from operator import itemgetter
+
+from ._stats import Statistics
+
+# The number of in-place timestamp shifts made through any array. Slices, copies and columnar views hold the
+# same datapoint dicts or timestamp column as the array they came from, so a shift through any of them must
+# clear the t() cache of all of them.
+_tshifts = [0]
+
+
+def iterate_json_array(f, blocksize=1 << 20):
+    """Incrementally parses a file holding a JSON array of objects, such as the data.json of an export,
+    yielding the elements one by one. The file is read in blocks, so that only the current block
+    needs to be held in memory, no matter how large the file is."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+    while True:
+        # Skip whitespace and separators, reading the next block when the current one is used up
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buf):
+            buf = f.read(blocksize)
+            pos = 0
+            if len(buf) == 0:
+                raise ValueError("Unexpected end of JSON array")
+            continue
+
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == "]":
+            return
+
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # The element continues past the current block
+            more = f.read(max(blocksize, len(buf) - pos))
+            if len(more) == 0:
+                raise
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield element
+        pos = end
+
+
+def bisect_timestamp(raw, t, right=False):
+    """Binary searches a list of datapoints sorted by timestamp, returning the index of the first datapoint
+    with a timestamp >= t (or > t if right is True), like the bisect module."""
+    lo = 0
+    hi = len(raw)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if raw[mid]["t"] < t or (right and raw[mid]["t"] == t):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
 
 class DatapointArray(list):
@@ -33,13 +97,60 @@ class DatapointArray(list):
             return self.d()
         d = list.__getitem__(self, key)
         if isinstance(key, slice):
-            d = DatapointArray(d)
-            d._d = self._d[key]
-            d._t = self._t[key]
+            return DatapointArray(d)
         return d
 
-    def sort(self, f=lambda d: d["t"]):
+    # The list's methods which modify it must clear the cached timestamp conversions
+    def __modified(self):
+        self.__dict__.pop("_tcache", None)
+
+    def __setitem__(self, key, value):
+        self.__modified()
+        list.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.__modified()
+        list.__delitem__(self, key)
+
+    def __iadd__(self, other):
+        self.__modified()
+        return list.__iadd__(self, other)
+
+    def __imul__(self, n):
+        self.__modified()
+        return list.__imul__(self, n)
+
+    def clear(self):
+        self.__modified()
+        list.__delitem__(self, slice(None))
+
+    def append(self, dp):
+        self.__modified()
+        list.append(self, dp)
+
+    def extend(self, array):
+        self.__modified()
+        list.extend(self, array)
+
+    def insert(self, index, dp):
+        self.__modified()
+        list.insert(self, index, dp)
+
+    def remove(self, dp):
+        self.__modified()
+        list.remove(self, dp)
+
+    def pop(self, *args):
+        self.__modified()
+        return list.pop(self, *args)
+
+    def reverse(self):
+        self.__modified()
+        list.reverse(self)
+
+    def sort(self, f=itemgetter("t")):
         """Sort here works by sorting by timestamp by default"""
+        self.__modified()
         list.sort(self, key=f)
         return self
 
@@ -47,10 +158,77 @@ class DatapointArray(list):
         """Returns just the data portion of the datapoints as a list"""
         return list(map(lambda x: x["d"], self.raw()))
 
-    def t(self):
-        """Returns just the timestamp portion of the datapoints as a list.
-        The timestamps are in python datetime's date format."""
-        return list(map(lambda x: datetime.datetime.fromtimestamp(x["t"]), self.raw()))
+    def t(self, format="datetime", tz=None):
+        """Returns just the timestamp portion of the datapoints. By default, the timestamps are a list
+        in python datetime's date format, in local time, or in the timezone tz (a tzinfo) if given.
+        The format can also be:
+
+        datetime64
+            a numpy datetime64[ns] array of UTC times, converted in a single vectorized step. Requires numpy.
+        float
+            the raw unix timestamps in seconds
+
+        The result is cached until the array is modified, or timestamps are shifted with tshift (of any array,
+        since arrays can share datapoints), so don't modify the returned values. Modifying the datapoint dicts
+        directly (rather than through the arrays' methods) does not clear the cache.
+        """
+        key = (format, tz)
+        version = _tshifts[0]
+        cache = self.__dict__.get("_tcache")
+        if cache is None or cache[0] != version:
+            cache = self.__dict__["_tcache"] = (version, {})
+        cache = cache[1]
+        if key not in cache:
+            if format == "datetime":
+                cache[key] = [datetime.datetime.fromtimestamp(x["t"], tz) for x in self.raw()]
+            elif format == "float":
+                cache[key] = [x["t"] for x in self.raw()]
+            elif format == "datetime64":
+                from .columnar import datetime64
+                cache[key] = datetime64(self.t("float"), tz)
+            else:
+                raise ValueError("Unknown timestamp format '%s'" % (format, ))
+        return cache[key]
+
+    def tslice(self, t1=None, t2=None):
+        """Returns the datapoints with timestamps in the range t1 <= t < t2, where a missing t1 or t2 leaves the range
+        open on that side. The array must be sorted by timestamp, since the range is found by binary search::
+
+            # The datapoints from the first hour
+            d.tslice(d[0]["t"], d[0]["t"] + 3600)
+        """
+        raw = self.raw()
+        i1 = 0 if t1 is None else bisect_timestamp(raw, t1)
+        i2 = len(raw) if t2 is None else bisect_timestamp(raw, t2)
+        return self[i1:max(i1, i2)]
+
+    def at(self, t, method="closest"):
+        """Returns the datapoint at the given time, or None if there is no such datapoint. The method
+        chooses which datapoint is returned:
+
+        before
+            the most recent datapoint with timestamp <= t
+        after
+            the first datapoint with timestamp >= t
+        closest
+            the datapoint closest to t (the earlier one if both are equally close)
+
+        The array must be sorted by timestamp, since the datapoint is found by binary search.
+        """
+        raw = self.raw()
+        if method == "before":
+            i = bisect_timestamp(raw, t, right=True)
+            return raw[i - 1] if i > 0 else None
+        if method == "after":
+            i = bisect_timestamp(raw, t)
+            return raw[i] if i < len(raw) else None
+        if method == "closest":
+            before = self.at(t, "before")
+            after = self.at(t, "after")
+            if before is None or (after is not None and after["t"] - t < t - before["t"]):
+                return after
+            return before
+        raise ValueError("Unknown method '%s'" % (method, ))
 
     def merge(self, array):
         """Adds the given array of datapoints to the generator.
@@ -66,6 +244,22 @@ class DatapointArray(list):
 
         return self
 
+    @staticmethod
+    def merge_many(arrays):
+        """Merges the given arrays of datapoints into a single new DatapointArray sorted by timestamp.
+        This is much faster than adding the arrays together one by one, since each datapoint is copied once::
+
+            d = DatapointArray.merge_many([stream1[:], stream2[:], stream3[:]])
+
+        The arrays don't need to be sorted, but merging k sorted arrays (such as stream reads)
+        takes O(N log k) time, since the sort merges the already sorted runs. Datapoints with
+        equal timestamps keep the order of the arrays they came from.
+        """
+        result = DatapointArray()
+        for array in arrays:
+            result.extend(array)
+        return result.sort()
+
     def raw(self):
         """Returns array as a raw python array. For cases where for some reason
         the DatapointArray wrapper does not work for you
@@ -73,6 +267,49 @@ class DatapointArray(list):
         """
         return list.__getitem__(self, slice(None, None))
 
+    def columnar(self, schema=None, paths=None):
+        """Returns a copy of the array as a ColumnarDatapointArray, which holds the timestamps and data
+        in numpy arrays. This uses far less memory for large arrays, and allows vectorized operations.
+        Given the JSON schema of object data, each property gets its own typed column.
+        Requires numpy."""
+        from .columnar import ColumnarDatapointArray
+        return ColumnarDatapointArray(self, schema=schema, paths=paths)
+
+    def to_pandas(self):
+        """Returns the datapoints as a pandas DataFrame indexed by timestamp, with object data split into
+        a column per key. See ColumnarDatapointArray.to_pandas. Requires numpy and pandas.
+
+        The columns are built from the datapoint dicts, so unlike ColumnarDatapointArray.to_pandas, this
+        always copies the data. Call columnar() once and convert that to avoid copying on each conversion."""
+        return self.columnar().to_pandas()
+
+    def to_arrow(self):
+        """Returns the datapoints as a pyarrow Table. See ColumnarDatapointArray.to_arrow.
+        Requires numpy and pyarrow."""
+        return self.columnar().to_arrow()
+
+    @staticmethod
+    def from_pandas(df):
+        """Creates a DatapointArray from a pandas DataFrame or Series, such as one returned by to_pandas.
+        See ColumnarDatapointArray.from_pandas. Requires numpy and pandas."""
+        from .columnar import ColumnarDatapointArray
+        return DatapointArray(ColumnarDatapointArray.from_pandas(df).raw())
+
+    def resample(self, dt, agg="mean", origin=0.):
+        """Groups the datapoints into time buckets of dt seconds, and aggregates each bucket into a single
+        datapoint, timestamped with the start of its bucket. Returns a new DatapointArray::
+
+            # Hourly means, and per-minute min and max computed in the same scan
+            hourly = d.resample(3600, "mean")
+            ranges = d.resample(60, ["min", "max"])
+
+        The supported aggregations are mean, sum, min, max, count, first and last. When given a list
+        of aggregations, the data of each resulting datapoint is a dict of the aggregated values.
+        The buckets start at origin, which is the unix epoch by default. The aggregation is vectorized
+        with numpy - see ColumnarDatapointArray.resample.
+        """
+        return self.columnar().resample(dt, agg, origin).datapoints()
+
     def writeJSON(self, filename):
         """Writes the data to the given file::
 
@@ -83,6 +320,24 @@ class DatapointArray(list):
         with open(filename, "w") as f:
             json.dump(self, f)
 
+    def writeBinary(self, filename):
+        """Writes the data to the given file in a compact binary format, which can be opened almost instantly
+        (even for very large arrays) using DatapointArray.open. Requires numpy - see ColumnarDatapointArray.writeBinary"""
+        self.columnar().writeBinary(filename)
+
+    @staticmethod
+    def open(filename, mmap=True):
+        """Opens a file written by writeBinary, returning a ColumnarDatapointArray. By default, the file
+        is memory-mapped, so that only the parts of the file that are used are read from disk::
+
+            DatapointArray(stream[:]).writeBinary("mystream.dpa")
+            d = DatapointArray.open("mystream.dpa")
+
+        Requires numpy - see ColumnarDatapointArray.open
+        """
+        from .columnar import ColumnarDatapointArray
+        return ColumnarDatapointArray.open(filename, mmap)
+
     def loadJSON(self, filename):
         """Adds the data from a JSON file. The file is expected to be in datapoint format::
 
@@ -92,6 +347,37 @@ class DatapointArray(list):
             self.merge(json.load(f))
         return self
 
+    @staticmethod
+    def iterJSON(filename, chunksize=None):
+        """Reads the datapoints of a JSON file (such as one written by writeJSON) incrementally, so that
+        files larger than memory can be processed. Yields the datapoints one by one, or if given a chunksize,
+        DatapointArrays of up to chunksize datapoints::
+
+            for chunk in DatapointArray.iterJSON("data.json", 10000):
+                print(chunk.mean())
+
+        Unlike loadJSON, the datapoints are returned in the order they are in the file, without sorting.
+        """
+        with open(filename, "r") as f:
+            if chunksize is None:
+                for dp in iterate_json_array(f):
+                    yield dp
+                return
+            chunk = DatapointArray()
+            for dp in iterate_json_array(f):
+                chunk.append(dp)
+                if len(chunk) >= chunksize:
+                    yield chunk
+                    chunk = DatapointArray()
+            if len(chunk) > 0:
+                yield chunk
+
+    @staticmethod
+    def iterExport(folder, chunksize=None):
+        """Reads the data of a ConnectorDB stream export incrementally. See iterJSON and loadExport.
+        Exports are written sorted by timestamp, so the datapoints are returned in order."""
+        return DatapointArray.iterJSON(os.path.join(folder, "data.json"), chunksize)
+
     def loadExport(self, folder):
         """Adds the data from a ConnectorDB export. If it is a stream export, then the folder
         is the location of the export. If it is a device export, then the folder is the export folder
@@ -106,6 +392,39 @@ class DatapointArray(list):
         self.loadJSON(os.path.join(folder, "data.json"))
         return self
 
+    def map_reduce(self, mapper, reducer, workers=None, chunksize=None, dt=None):
+        """Splits the array into chunks, runs mapper on each chunk (as a DatapointArray) in a pool of worker
+        processes, and combines the results of the chunks in order with reducer, which gets two results
+        and returns the combined result. This allows CPU-heavy python analysis to use all cores::
+
+            def count_hot(chunk):
+                return sum(1 for dp in chunk if dp["d"] > 80)
+
+            hot = d.map_reduce(count_hot, operator.add)
+
+        The array is split into chunks of chunksize datapoints (by default 4 chunks per worker), or into
+        time buckets of dt seconds if given. The mapper and reducer must be picklable (such as functions
+        defined at the top level of a module). The datapoints are copied once into shared memory, from which
+        each worker reads its chunk, rather than sending pickled datapoints to the workers (this needs
+        numpy and python 3.8 or newer, and falls back to pickling otherwise).
+
+        Returns None if the array is empty.
+        """
+        from ._mapreduce import map_reduce
+        return map_reduce(self, mapper, reducer, workers, chunksize, dt)
+
+    def transform(self, script):
+        """Runs the given PipeScript transform on the datapoints locally, returning a new DatapointArray.
+        A vectorized subset of PipeScript is supported - see connectordb.pipescript.transform::
+
+            d = DatapointArray([{"t": 1, "d": 3}, {"t": 2, "d": 8}, {"t": 3, "d": 6}])
+            print(d.transform("if $ > 5 | sum")) # [{"t": 2, "d": 8}, {"t": 3, "d": 14}]
+
+        Requires numpy.
+        """
+        from .pipescript import transform
+        return transform(self, script)
+
     def tshift(self, t):
         """Shifts all timestamps in the datapoint array by the given number of seconds.
         It is the same as the 'tshift' pipescript transform.
@@ -116,6 +435,8 @@ class DatapointArray(list):
             d.tshift(20)
             print(d) # [{"t":76,"d":1}]
         """
+        self.__modified()
+        _tshifts[0] += 1
         raw = self.raw()
         for i in range(len(raw)):
             raw[i]["t"] += t
@@ -132,3 +453,8 @@ class DatapointArray(list):
     def mean(self):
         """Gets the mean of the data portions of all datapoints within"""
         return self.sum() / float(len(self))
+
+    def statistics(self):
+        """Returns a Statistics object with the count, mean, variance, extremes, quantiles and number of
+        distinct values of the data. Statistics of several arrays can be combined with Statistics.merge."""
+        return Statistics().update(self)
@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 import json
+import logging
 import os
+import threading
 
 from ._connection import DatabaseConnection
 from ._connectorobject import ConnectorObject
@@ -47,6 +49,53 @@ class Device(ConnectorObject):
         """Gets the child stream by name"""
         return Stream(self.db, self.path + "/" + stream_name)
 
+    def insert_many(self, data, restamp=False, workers=4):
+        """Inserts datapoints into multiple streams of the device at once. The data is either a dict of the
+        form {streamname: [{"t": timestamp, "d": data}, ...]}, or an iterable of (streamname, datapoint) tuples,
+        which are grouped by stream::
+
+            errors = dev.insert_many({
+                "temperature": [{"t": time.time(), "d": 73}],
+                "humidity": [{"t": time.time(), "d": 0.4}]
+            })
+
+        The streams are uploaded concurrently by the given number of worker threads, each stream in order,
+        using insert_array. A failure in one stream does not stop the others. Returns a dict of
+        {streamname: exception} for the streams which failed, which is empty if all inserts succeeded.
+        """
+        if workers < 1:
+            raise ValueError("insert_many needs at least one worker")
+        if not isinstance(data, dict):
+            grouped = {}
+            for streamname, dp in data:
+                grouped.setdefault(streamname, []).append(dp)
+            data = grouped
+
+        streamnames = list(data.keys())
+        errors = {}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if len(streamnames) == 0:
+                        return
+                    streamname = streamnames.pop()
+                try:
+                    self[streamname].insert_array(data[streamname], restamp=restamp)
+                except Exception as e:
+                    logging.debug("%s: insert into %s failed: %s", self.path, streamname, str(e))
+                    with lock:
+                        errors[streamname] = e
+
+        threads = [threading.Thread(target=worker) for _ in range(min(workers, len(streamnames)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
     def __repr__(self):
         """Returns a string representation of the device"""
         return "[Device:%s]" % (self.path, )
@@ -69,22 +118,30 @@ class Device(ConnectorObject):
         for s in self.streams():
             s.export(os.path.join(directory, s.name))
 
-    def import_stream(self, directory):
+    def import_stream(self, directory, session=None):
         """Imports a stream from the given directory. You export the Stream
-        by using stream.export()"""
+        by using stream.export()
+
+        If given an UploadSession, the stream's data is inserted through the session, so that
+        an interrupted import can be resumed by running the import again with the same session::
+
+            dev.import_stream("./exportdir/mystream", connectordb.UploadSession("import.checkpoint"))
+        """
 
         # read the stream's info
         with open(os.path.join(directory, "stream.json"), "r") as f:
             sdata = json.load(f)
 
         s = self[sdata["name"]]
-        if s.exists():
+        if not s.exists():
+            # Create the stream empty first, so we can insert all the data without
+            # worrying about schema violations or downlinks
+            s.create()
+        elif session is None or not (session.started(s) or len(s) == 0):
+            # A resumed import continues in the stream that it created, which is still empty
+            # if the import was interrupted before the session recorded anything
             raise ValueError("The stream " + s.name + " already exists")
 
-        # Create the stream empty first, so we can insert all the data without
-        # worrying about schema violations or downlinks
-        s.create()
-
         # Now, in order to insert data into this stream, we must be logged in as
         # the owning device
         ddb = DatabaseConnection(self.apikey, url=self.db.baseurl)
@@ -93,8 +150,12 @@ class Device(ConnectorObject):
         # Set up the owning device
         sown = d[s.name]
 
-        # read the stream's info
-        sown.insert_array(DatapointArray().loadExport(directory))
+        # Stream the data from the export into the stream, so that the export never needs to fit in memory.
+        # Exports are written sorted by timestamp, so the data can be inserted as it is read.
+        if session is None:
+            sown.insert_array(DatapointArray.iterExport(directory))
+        else:
+            session.insert_array(sown, DatapointArray.iterExport(directory))
 
         # Now we MIGHT be able to recover the downlink data,
         # only if we are not logged in as the device that the stream is being inserted into
@@ -102,8 +163,11 @@ class Device(ConnectorObject):
         # downlink stream
         if (sdata["downlink"] and self.db.path != self.path):
             s.downlink = True
-            with open(os.path.join(directory, "downlink.json"), "r") as f:
-                s.insert_array(json.load(f))
+            downlink = DatapointArray.iterJSON(os.path.join(directory, "downlink.json"))
+            if session is None:
+                s.insert_array(downlink)
+            else:
+                session.insert_array(s, downlink, downlink=True)
 
         # And finally, update the device
         del sdata["name"]
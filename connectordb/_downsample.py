@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+
+from ._datapointarray import DatapointArray
+
+
+class Downsampler(object):
+    """Downsampler is the base of the streaming reducers used by Stream.preview. A downsampler
+    splits the time range [t1, t2] into equally sized time buckets, and is fed the datapoints
+    in chunks, in increasing timestamp order. It only holds on to the datapoints of the buckets
+    that are still undecided, so memory use stays bounded no matter how large the range is::
+
+        ds = MinMaxDownsampler(t1, t2, 2000)
+        for chunk in stream.chunks(t1=t1, t2=t2):
+            ds.add(chunk)
+        result = ds.result()
+
+    The data portion of the datapoints must be numeric.
+    """
+
+    def __init__(self, t1, t2, buckets):
+        if buckets < 1:
+            raise ValueError("At least one bucket is required for downsampling")
+        self.t1 = float(t1)
+        self.buckets = buckets
+        self.width = (float(t2) - self.t1) / buckets
+        self.output = DatapointArray()
+
+    def bucket(self, t):
+        """Returns the index of the bucket which holds the given timestamp"""
+        if self.width <= 0:
+            return 0
+        b = int((t - self.t1) / self.width)
+        if b < 0:
+            return 0
+        if b >= self.buckets:
+            return self.buckets - 1
+        return b
+
+    def add(self, datapoints):
+        """Adds the given datapoints (sorted by timestamp) to the downsampler"""
+        for dp in datapoints:
+            self.add_datapoint(dp)
+
+    def add_datapoint(self, dp):
+        raise NotImplementedError()
+
+    def result(self):
+        """Returns the downsampled DatapointArray. Must only be called once all data was added."""
+        raise NotImplementedError()
+
+
+class MinMaxDownsampler(Downsampler):
+    """Keeps the minimum and maximum datapoint of each time bucket. This preserves all of the
+    spikes in the data, which makes it well suited for plotting. Like with LTTB, the first and last
+    datapoints are always kept, so that the plot covers the whole range. Since each bucket can give two
+    datapoints, the number of buckets is half the number of requested points left after those two."""
+
+    def __init__(self, t1, t2, points):
+        Downsampler.__init__(self, t1, t2, max(1, (points - 2) // 2))
+        self.current = None
+        self.mindp = None
+        self.maxdp = None
+        self.first = None
+        self.last = None
+
+    def __close(self):
+        if self.current is None:
+            return
+        if self.mindp is self.maxdp:
+            self.output.append(self.mindp)
+        elif self.mindp["t"] <= self.maxdp["t"]:
+            self.output.append(self.mindp)
+            self.output.append(self.maxdp)
+        else:
+            self.output.append(self.maxdp)
+            self.output.append(self.mindp)
+
+    def add_datapoint(self, dp):
+        if self.first is None:
+            self.first = dp
+        self.last = dp
+        b = self.bucket(dp["t"])
+        if b != self.current:
+            self.__close()
+            self.current = b
+            self.mindp = dp
+            self.maxdp = dp
+            return
+        if dp["d"] < self.mindp["d"]:
+            self.mindp = dp
+        if dp["d"] > self.maxdp["d"]:
+            self.maxdp = dp
+
+    def result(self):
+        self.__close()
+        self.current = None
+        if self.last is not None:
+            if self.output[0] is not self.first:
+                self.output.insert(0, self.first)
+            if self.output[-1] is not self.last:
+                self.output.append(self.last)
+        return self.output
+
+
+class LTTBDownsampler(Downsampler):
+    """Largest-Triangle-Three-Buckets downsampling. The first and last datapoints are always kept,
+    and from each bucket in between, the datapoint which forms the largest triangle with the
+    previously chosen datapoint and the average of the following bucket is chosen.
+
+    Unlike the textbook version of the algorithm, the buckets are equal time intervals rather than
+    equal numbers of datapoints, which allows the reduction to run while the data is being read.
+    Empty buckets are skipped."""
+
+    def __init__(self, t1, t2, points):
+        Downsampler.__init__(self, t1, t2, max(1, points - 2))
+
+        # The previously selected datapoint
+        self.previous = None
+        # The bucket waiting for its successor to be complete, so that a datapoint can be chosen
+        self.current = []
+        # The bucket currently being filled
+        self.pending = []
+        self.pending_index = None
+        self.last = None
+
+    def __select(self, ct, cd):
+        """Chooses the datapoint of the current bucket forming the largest triangle"""
+        at = self.previous["t"]
+        ad = self.previous["d"]
+        best = None
+        bestarea = -1.
+        for dp in self.current:
+            area = abs((at - ct) * (dp["d"] - ad) - (at - dp["t"]) * (cd - ad))
+            if area > bestarea:
+                bestarea = area
+                best = dp
+        self.output.append(best)
+        self.previous = best
+
+    def __average(self, bucket):
+        n = float(len(bucket))
+        return (sum(dp["t"] for dp in bucket) / n, sum(dp["d"] for dp in bucket) / n)
+
+    def add_datapoint(self, dp):
+        self.last = dp
+        if self.previous is None:
+            # The first datapoint is always part of the result
+            self.output.append(dp)
+            self.previous = dp
+            return
+        b = self.bucket(dp["t"])
+        if b != self.pending_index:
+            if len(self.current) > 0:
+                self.__select(*self.__average(self.pending))
+            if len(self.pending) > 0:
+                self.current = self.pending
+            self.pending = []
+            self.pending_index = b
+        self.pending.append(dp)
+
+    def result(self):
+        if self.last is None:
+            return self.output
+        if len(self.pending) > 0:
+            if len(self.current) > 0:
+                self.__select(*self.__average(self.pending))
+            self.current = self.pending
+        if len(self.current) > 0:
+            self.__select(self.last["t"], self.last["d"])
+        if self.output[-1] is not self.last:
+            # The last datapoint is always part of the result
+            self.output.append(self.last)
+        self.current = []
+        self.pending = []
+        return self.output
+
+
+# The downsampling methods supported by Stream.preview
+DOWNSAMPLERS = {
+    "lttb": LTTBDownsampler,
+    "minmax": MinMaxDownsampler
+}
@@ -0,0 +1,222 @@
+from __future__ import absolute_import
+
+import re
+
+import six
+
+from ._datapointarray import DatapointArray
+
+_STRINGS = re.compile(r'"(?:[^"\\]|\\.)*"')
+_NAMES = re.compile(r"(?<![\w.])[A-Za-z_]\w*")
+_PERDATAPOINT_NAMES = set(["if", "and", "or", "not", "true", "false"])
+
+
+def _perdatapoint(script):
+    """Returns whether the PipeScript transform only uses $, literals and operators, so that each datapoint's
+    result doesn't depend on other datapoints, and the transform can be run separately on chunks of a stream"""
+    names = _NAMES.findall(_STRINGS.sub("", script))
+    return all(name in _PERDATAPOINT_NAMES for name in names)
+
+
+class LazyQuery(object):
+    """LazyQuery is a deferred query of a stream's datapoints. Each method adds a step to the query's plan
+    and returns a new LazyQuery, and nothing is read from ConnectorDB until the datapoints are used::
+
+        q = stream.lazy().tslice(time.time() - 3600).where("$ > 50").tshift(60).limit(100)
+        print(q.explain())
+
+        for dp in q:
+            print(dp)
+
+    As much of the plan as possible is pushed to ConnectorDB: time ranges become the t1 and t2 of the query,
+    PipeScript conditions and transforms become its transform, and limits its limit, so that datapoints
+    which would be thrown away are never downloaded. The remaining steps run locally, with python functions
+    as conditions, and PipeScript using connectordb.pipescript (which requires numpy).
+
+    Steps are pushed to the server only when that gives the same result as running them in order,
+    so the order of steps matters. For instance, a limit and a transform are only both pushed
+    if the transform comes first. Index ranges must be given before all other steps.
+
+    Unless a limit or a transform that depends on previous datapoints (such as sum) is pushed to the server,
+    the datapoints are read in chunks (see Stream.chunks), with conditions such as "$ > 50" run on the server
+    for each chunk. Reading then stops once a local limit is reached, so that stream.lazy().where("$ > 50").limit(3)
+    only reads the chunks it needs. Pushed limits and other transforms are read in a single query.
+    """
+
+    def __init__(self, stream, downlink=False, steps=()):
+        self.stream = stream
+        self.downlink = downlink
+        self.steps = tuple(steps)
+
+    def __add(self, *step):
+        return LazyQuery(self.stream, self.downlink, self.steps + (step, ))
+
+    def __getitem__(self, getrange):
+        """Restricts the query to the given slice of the stream's datapoints, such as stream.lazy()[-100:]"""
+        if not isinstance(getrange, slice) or getrange.step is not None:
+            raise ValueError("A lazy query can only be sliced with a range of indices")
+        if len(self.steps) > 0:
+            raise ValueError("Index ranges must come before all other steps of a lazy query")
+        return self.__add("index", getrange.start, getrange.stop)
+
+    def tslice(self, t1=None, t2=None):
+        """Keeps only the datapoints with timestamps in the range t1 <= t < t2"""
+        return self.__add("tslice", t1, t2)
+
+    def where(self, condition):
+        """Keeps only the datapoints matching the condition. The condition is either a PipeScript condition
+        such as "$ > 50", or a python function which is given each datapoint, and returns whether to keep it"""
+        if isinstance(condition, six.string_types):
+            return self.__add("transform", "if " + condition)
+        return self.__add("filter", condition)
+
+    def transform(self, script):
+        """Runs the given PipeScript transform on the datapoints"""
+        return self.__add("transform", script)
+
+    def tshift(self, t):
+        """Shifts the timestamps of the datapoints by the given number of seconds"""
+        return self.__add("tshift", t)
+
+    def limit(self, n):
+        """Keeps only the first n datapoints"""
+        return self.__add("limit", n)
+
+    def __plan(self):
+        """Splits the steps into the server query parameters, the transforms pushed to the server,
+        and the steps that run locally"""
+        bounds = {}
+        pushed = []
+        local = []
+        # The total tshift of the local steps, all of which are tshifts while steps can still be pushed
+        shift = 0
+        for step in self.steps:
+            kind = step[0]
+            pushable = all(s[0] == "tshift" for s in local)
+            if kind == "index":
+                bounds["i1"] = step[1] if step[1] is not None else 0
+                bounds["i2"] = step[2] if step[2] is not None else 0
+            elif kind == "tslice":
+                if pushable and len(pushed) == 0 and "limit" not in bounds and "i2" not in bounds:
+                    if step[1] is not None:
+                        bounds["t1"] = max(bounds.get("t1", step[1] - shift), step[1] - shift)
+                    if step[2] is not None:
+                        bounds["t2"] = min(bounds.get("t2", step[2] - shift), step[2] - shift)
+                else:
+                    local.append(step)
+            elif kind == "transform":
+                if pushable and "limit" not in bounds:
+                    pushed.append(step[1])
+                else:
+                    local.append(step)
+            elif kind == "limit":
+                if pushable and len(pushed) == 0 and "limit" not in bounds and "i2" not in bounds:
+                    bounds["limit"] = step[1]
+                else:
+                    local.append(step)
+            else:
+                if kind == "tshift" and pushable:
+                    shift += step[1]
+                local.append(step)
+        return bounds, pushed, local
+
+    def explain(self):
+        """Returns a dict describing how the query will be run: the "query" parameters sent to ConnectorDB,
+        and the "local" steps run on the returned datapoints"""
+        bounds, pushed, local = self.__plan()
+        query = dict(bounds)
+        if len(pushed) > 0:
+            query["transform"] = " | ".join(pushed)
+        return {"query": query, "local": [step[0] for step in local]}
+
+    def __read(self, bounds, pushed, chunked):
+        """Reads the datapoints of the server part of the plan, in chunks if chunked is True"""
+        transform = " | ".join(pushed) if len(pushed) > 0 else None
+        if chunked and "limit" not in bounds and (transform is None or _perdatapoint(transform)):
+            return self.stream.chunks(bounds.get("t1"), bounds.get("t2"), bounds.get("i1"), bounds.get("i2"),
+                                      downlink=self.downlink, transform=transform)
+        return [self.stream(t1=bounds.get("t1"), t2=bounds.get("t2"), limit=bounds.get("limit"),
+                            i1=bounds.get("i1"), i2=bounds.get("i2"), downlink=self.downlink, transform=transform)]
+
+    def chunks(self):
+        """Runs the query, iterating through DatapointArrays of the results"""
+        bounds, pushed, local = self.__plan()
+
+        # PipeScript transforms can depend on all previous datapoints (such as sum), so they
+        # need all of the datapoints at once
+        chunked = all(step[0] != "transform" for step in local)
+        source = self.__read(bounds, pushed, chunked)
+
+        remaining = [step[1] if step[0] == "limit" else None for step in local]
+        for chunk in source:
+            done = False
+            for i, step in enumerate(local):
+                kind = step[0]
+                if kind == "tshift":
+                    chunk = DatapointArray(chunk).tshift(step[1])
+                elif kind == "tslice":
+                    chunk = DatapointArray(chunk).tslice(step[1], step[2])
+                elif kind == "filter":
+                    chunk = DatapointArray([dp for dp in chunk if step[1](dp)])
+                elif kind == "transform":
+                    from .pipescript import transform
+                    chunk = transform(chunk, step[1])
+                elif kind == "limit":
+                    chunk = DatapointArray(chunk.raw()[:remaining[i]])
+                    remaining[i] -= len(chunk)
+                    done = done or remaining[i] <= 0
+            if len(chunk) > 0:
+                yield chunk
+            if done:
+                return
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for dp in chunk:
+                yield dp
+
+    def collect(self):
+        """Runs the query, returning all of the results in a DatapointArray"""
+        result = DatapointArray()
+        for chunk in self.chunks():
+            result.extend(chunk)
+        return result
+
+    def __aggregate(self, script):
+        """Runs the given aggregation on the server if the whole plan can be pushed. Returns the aggregated
+        value (None if there are no datapoints), and whether the aggregation was run"""
+        bounds, pushed, local = self.__plan()
+        if len(local) > 0 or "limit" in bounds:
+            return None, False
+        result = self.__read(bounds, pushed + [script, "if last"], False)[0]
+        return (result[-1]["d"] if len(result) > 0 else None), True
+
+    def count(self):
+        """Returns the number of datapoints in the result, counted by ConnectorDB if possible"""
+        value, pushed = self.__aggregate("count")
+        if pushed:
+            return 0 if value is None else value
+        return sum(len(chunk) for chunk in self.chunks())
+
+    def sum(self):
+        """Returns the sum of the data of the result's datapoints, computed by ConnectorDB if possible"""
+        value, pushed = self.__aggregate("sum")
+        if pushed:
+            return 0 if value is None else value
+        return sum(chunk.sum() for chunk in self.chunks())
+
+    def mean(self):
+        """Returns the mean of the data of the result's datapoints (or None if there are none),
+        computed by ConnectorDB if possible"""
+        value, pushed = self.__aggregate("mean")
+        if pushed:
+            return value
+        count = 0
+        total = 0
+        for chunk in self.chunks():
+            count += len(chunk)
+            total += chunk.sum()
+        return total / float(count) if count > 0 else None
+
+    def __repr__(self):
+        return "LazyQuery(%s, %s)" % (self.stream.path, self.explain())
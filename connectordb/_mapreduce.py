@@ -0,0 +1,188 @@
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+
+try:
+    from multiprocessing import shared_memory
+    import numpy
+except ImportError:
+    # Without numpy, or on python < 3.8, chunks are pickled and sent to the workers instead
+    shared_memory = None
+
+from ._datapointarray import DatapointArray
+
+# The data column in shared memory starts at a multiple of this many bytes
+_ALIGNMENT = 64
+
+
+def _attach(name):
+    try:
+        # The creating process unlinks the block, so the workers must not track it
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def share(array):
+    """Copies the given DatapointArray or ColumnarDatapointArray into a new block of shared memory.
+    Returns the SharedMemory object, which the caller must close and unlink, and a small picklable
+    description of the block, which lets other processes read the datapoints with attach.
+
+    The block holds the float64 timestamps, followed by the typed data column for numeric data,
+    or the offsets and json encoding of each datapoint's data otherwise."""
+    import numpy as np
+    from .columnar import ColumnarDatapointArray, records
+    if not isinstance(array, ColumnarDatapointArray):
+        array = ColumnarDatapointArray(array)
+    n = len(array)
+    doffset = -(-8 * n // _ALIGNMENT) * _ALIGNMENT
+    desc = {"n": n, "doffset": doffset}
+    if array.dcol.dtype == object or array.dcol.dtype.names is not None:
+        encoded = [json.dumps(d).encode("utf-8") for d in records(array.dcol)]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        dbytes = offsets.tobytes() + b"".join(encoded)
+        desc["dtype"] = "json"
+    else:
+        dbytes = array.dcol.tobytes()
+        desc["dtype"] = array.dcol.dtype.str
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, doffset + len(dbytes)))
+    shm.buf[:8 * n] = array.tcol.astype(np.float64).tobytes()
+    shm.buf[doffset:doffset + len(dbytes)] = dbytes
+    desc["name"] = shm.name
+    return shm, desc
+
+
+def attach(desc, i1=0, i2=None):
+    """Reads the datapoints i1 to i2 of a block of shared memory created by share, returning a DatapointArray"""
+    import numpy as np
+    shm = _attach(desc["name"])
+    try:
+        n = desc["n"]
+        i2 = n if i2 is None else i2
+        t = np.frombuffer(shm.buf, dtype=np.float64, count=n)[i1:i2].tolist()
+        if desc["dtype"] == "json":
+            offsets = np.frombuffer(shm.buf, dtype=np.int64, count=n + 1, offset=desc["doffset"]).tolist()
+            start = desc["doffset"] + 8 * (n + 1)
+            d = [json.loads(bytes(shm.buf[start + offsets[i]:start + offsets[i + 1]]).decode("utf-8"))
+                 for i in range(i1, i2)]
+        else:
+            d = np.frombuffer(shm.buf, dtype=desc["dtype"], count=n, offset=desc["doffset"])[i1:i2].tolist()
+        # All views of the buffer must be gone before it is closed
+        return DatapointArray([{"t": ti, "d": di} for ti, di in zip(t, d)])
+    finally:
+        shm.close()
+
+
+def _map(args):
+    """Runs in the worker processes: reads a chunk, and runs the mapper on it"""
+    mapper, chunk = args
+    if isinstance(chunk, dict):
+        chunk = attach(chunk, chunk["i1"], chunk["i2"])
+    return mapper(chunk)
+
+
+class _Reducer(object):
+    """Combines the mapped results in order"""
+
+    def __init__(self, reducer):
+        self.reducer = reducer
+        self.result = None
+        self.empty = True
+
+    def add(self, value):
+        if self.empty:
+            self.result = value
+            self.empty = False
+        else:
+            self.result = self.reducer(self.result, value)
+
+
+def partitions(array, chunksize=None, dt=None, workers=1):
+    """Returns a list of (i1, i2) index ranges that split up the array, either into chunks of chunksize
+    datapoints, or into time buckets of dt seconds (the array must then be sorted by timestamp).
+    By default, the array is split into 4 chunks for each worker."""
+    n = len(array)
+    if dt is not None:
+        from .columnar import ColumnarDatapointArray
+        import numpy as np
+        tcol = array.tcol if isinstance(array, ColumnarDatapointArray) else np.array(array.t("float"))
+        if n == 0:
+            return []
+        buckets = np.floor(tcol / float(dt))
+        starts = np.concatenate(([0], np.nonzero(buckets[1:] != buckets[:-1])[0] + 1)).tolist()
+        return list(zip(starts, starts[1:] + [n]))
+    if chunksize is None:
+        chunksize = max(1, -(-n // (4 * workers)))
+    return [(i, min(i + chunksize, n)) for i in range(0, n, chunksize)]
+
+
+def map_reduce(array, mapper, reducer, workers=None, chunksize=None, dt=None):
+    """Runs mapper on chunks of the array in a pool of worker processes, and combines the results
+    in order with reducer. See DatapointArray.map_reduce."""
+    workers = workers or multiprocessing.cpu_count()
+    ranges = partitions(array, chunksize, dt, workers)
+    reduced = _Reducer(reducer)
+    if len(ranges) == 0:
+        return None
+
+    shm = None
+    if shared_memory is not None:
+        shm, desc = share(array)
+        chunks = [dict(desc, i1=i1, i2=i2) for i1, i2 in ranges]
+    else:
+        raw = array.raw()
+        chunks = [DatapointArray(raw[i1:i2]) for i1, i2 in ranges]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(_map, [(mapper, chunk) for chunk in chunks]):
+            reduced.add(result)
+    finally:
+        pool.terminate()
+        pool.join()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    return reduced.result
+
+
+def map_reduce_chunks(chunks, mapper, reducer, workers=None):
+    """Runs mapper on each of the given chunks of datapoints (such as the chunks of a stream) in a pool of
+    worker processes, while the chunks are being read, and combines the results in order with reducer.
+    At most two chunks per worker are held in memory at a time."""
+    workers = workers or multiprocessing.cpu_count()
+    reduced = _Reducer(reducer)
+    pending = []
+    pool = multiprocessing.Pool(workers)
+
+    def finish():
+        result, shm = pending.pop(0)
+        try:
+            reduced.add(result.get())
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    try:
+        for chunk in chunks:
+            if len(pending) >= 2 * workers:
+                finish()
+            shm = None
+            if shared_memory is not None and len(chunk) > 0:
+                shm, desc = share(chunk)
+                chunk = dict(desc, i1=0, i2=len(chunk))
+            pending.append((pool.apply_async(_map, ((mapper, chunk), )), shm))
+        while len(pending) > 0:
+            finish()
+    finally:
+        pool.terminate()
+        pool.join()
+        for _, shm in pending:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+    return reduced.result
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+
+import heapq
+import json
+import os
+import tempfile
+from operator import itemgetter
+
+from ._datapointarray import DatapointArray
+
+
+def _decorate(run, runindex):
+    """Turns the datapoints of a sorted run into tuples which sort by timestamp, and then by their position
+    in the input, so that the merge is stable and never compares the datapoints themselves"""
+    for i, dp in enumerate(run):
+        yield (dp["t"], runindex, i, dp)
+
+
+class DatapointSorter(object):
+    """DatapointSorter sorts datapoints from any number of unsorted sources by timestamp, using a fixed amount
+    of memory no matter how many datapoints there are. Once run_size datapoints were added, they are sorted
+    and written to a temporary file, and iterating over the sorter merges these sorted runs::
+
+        with connectordb.DatapointSorter() as sorter:
+            sorter.addJSON("2015.json")
+            sorter.addJSON("2016.json")
+            sorter.add(load_csv("older.csv"))
+
+            cdb["mystream"].insert_array(sorter)
+
+    Only run_size datapoints are held in memory while adding datapoints, and one datapoint per run
+    while iterating. Datapoints with equal timestamps keep the order in which they were added.
+
+    The temporary files are removed when the sorter is closed.
+    """
+
+    def __init__(self, run_size=500000, tmpdir=None):
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self.runs = []
+        self.buffer = []
+        self.count = 0
+
+    def add(self, datapoints):
+        """Adds the datapoints of the given list or iterable"""
+        for dp in datapoints:
+            self.buffer.append(dp)
+            self.count += 1
+            if len(self.buffer) >= self.run_size:
+                self.__spill()
+        return self
+
+    def addJSON(self, filename):
+        """Adds the datapoints of a JSON file, which is read incrementally (see DatapointArray.iterJSON)"""
+        return self.add(DatapointArray.iterJSON(filename))
+
+    def addExport(self, folder):
+        """Adds the datapoints of a ConnectorDB stream export"""
+        return self.add(DatapointArray.iterExport(folder))
+
+    def __spill(self):
+        """Sorts the buffered datapoints, and writes them to a temporary file as a sorted run"""
+        self.buffer.sort(key=itemgetter("t"))
+        fd, filename = tempfile.mkstemp(suffix=".jsonl", prefix="cdbsort", dir=self.tmpdir)
+        self.runs.append(filename)
+        with os.fdopen(fd, "w") as f:
+            for dp in self.buffer:
+                f.write(json.dumps(dp))
+                f.write("\n")
+        self.buffer = []
+
+    def __readrun(self, filename):
+        with open(filename, "r") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yields all of the added datapoints, sorted by timestamp"""
+        self.buffer.sort(key=itemgetter("t"))
+        runs = [self.__readrun(filename) for filename in self.runs] + [iter(self.buffer)]
+        for _, _, _, dp in heapq.merge(*[_decorate(run, i) for i, run in enumerate(runs)]):
+            yield dp
+
+    def chunks(self, chunksize=10000):
+        """Yields the sorted datapoints in DatapointArrays of up to chunksize datapoints"""
+        chunk = []
+        for dp in self:
+            chunk.append(dp)
+            if len(chunk) >= chunksize:
+                yield DatapointArray(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            yield DatapointArray(chunk)
+
+    def close(self):
+        """Removes the temporary files, and clears the sorter"""
+        for filename in self.runs:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.runs = []
+        self.buffer = []
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
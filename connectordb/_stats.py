@@ -0,0 +1,267 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import math
+import numbers
+import random
+import struct
+import threading
+
+
+class QuantileSketch(object):
+    """QuantileSketch estimates quantiles of a stream of values in a single pass, using a KLL sketch.
+    Values go into a hierarchy of compactors: once a level is full, it is sorted, and every other
+    value moves up a level, where each value stands for twice as many. The memory use stays at about
+    3k values, no matter how many values are added, and the rank error is around 1.7/k.
+    The values only need to be comparable with each other. Sketches with the same k can be merged."""
+
+    def __init__(self, k=200):
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        self.maxsize = 0
+        self.__grow()
+
+    def __capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2. / 3.)**depth)) + 1
+
+    def __grow(self):
+        self.compactors.append([])
+        self.maxsize = sum(self.__capacity(h) for h in range(len(self.compactors)))
+
+    def __compress(self):
+        for h in range(len(self.compactors)):
+            level = self.compactors[h]
+            if len(level) >= self.__capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self.__grow()
+                level.sort()
+                # Keep one value at this level if there is an odd number of them
+                start = len(level) % 2
+                self.compactors[h + 1].extend(level[start + random.randint(0, 1)::2])
+                self.compactors[h] = level[:start]
+                self.size = sum(len(c) for c in self.compactors)
+                return
+
+    def add(self, value):
+        """Adds a single value to the sketch"""
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.maxsize:
+            self.__compress()
+
+    def merge(self, other):
+        """Adds all values of the other sketch to this one"""
+        while len(self.compactors) < len(other.compactors):
+            self.__grow()
+        for h in range(len(other.compactors)):
+            self.compactors[h].extend(other.compactors[h])
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.maxsize:
+            self.__compress()
+        return self
+
+    def quantile(self, q):
+        """Returns the estimated q-quantile (0 <= q <= 1) of the values, or None if there are no values"""
+        if q < 0 or q > 1:
+            raise ValueError("The quantile must be between 0 and 1")
+        weighted = sorted((v, 1 << h) for h in range(len(self.compactors)) for v in self.compactors[h])
+        if len(weighted) == 0:
+            return None
+        total = sum(w for _, w in weighted)
+        cumulative = 0
+        for v, w in weighted:
+            cumulative += w
+            if cumulative >= q * total:
+                return v
+        return weighted[-1][0]
+
+
+class DistinctSketch(object):
+    """DistinctSketch estimates the number of distinct values in a stream, using a HyperLogLog sketch
+    of 2**precision registers. With the default precision of 12, it uses 4KB, and the estimate is
+    typically within 2% of the real count. Values are hashed by their JSON encoding, so any datapoint
+    data can be counted, and sketches from different processes can be merged."""
+
+    def __init__(self, precision=12):
+        if precision < 4 or precision > 16:
+            raise ValueError("The precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """Adds a single value to the sketch"""
+        key = json.dumps(value, sort_keys=True).encode("utf-8")
+        h = struct.unpack(">Q", hashlib.sha1(key).digest()[:8])[0]
+        bits = 64 - self.precision
+        idx = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        """Adds all values of the other sketch to this one. Both sketches must have the same precision."""
+        if other.precision != self.precision:
+            raise ValueError("Can't merge distinct sketches of different precision")
+        for i in range(len(self.registers)):
+            if other.registers[i] > self.registers[i]:
+                self.registers[i] = other.registers[i]
+        return self
+
+    def count(self):
+        """Returns the estimated number of distinct values"""
+        m = float(len(self.registers))
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # Small cardinalities are estimated much better by counting the empty registers
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class Statistics(object):
+    """Statistics computes summary statistics of datapoints in a single pass, without holding them in memory.
+    It keeps the count, sum, mean and variance (using Welford's algorithm), minimum and maximum of numeric data,
+    approximate quantiles of numeric data, and the approximate number of distinct values::
+
+        stats = connectordb.Statistics()
+        for chunk in cdb["temperature"].chunks():
+            stats.update(chunk)
+        print(stats.mean, stats.stddev, stats.quantile(0.95))
+
+    Statistics objects can also be given directly to Stream.subscribe, to keep statistics of
+    datapoints as they are inserted::
+
+        stats = connectordb.Statistics()
+        cdb["temperature"].subscribe(stats)
+
+    Statistics of separate chunks or processes can be combined with merge. Statistics objects can be pickled.
+    The count includes all datapoints, while the numeric statistics only use datapoints with numeric data.
+    """
+
+    def __init__(self, k=200, precision=12):
+        """k is the size of the quantile sketch, and precision the size of the distinct value sketch,
+        which both trade memory for accuracy"""
+        self.count = 0
+        self.numeric_count = 0
+        self.mean = None
+        self.min = None
+        self.max = None
+        self.__m2 = 0.
+        # The sum is kept with a compensation term, so that rounding errors don't add up
+        self.__sum = 0
+        self.__compensation = 0.
+        self.quantiles = QuantileSketch(k)
+        self.distinct = DistinctSketch(precision)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __add(self, value):
+        self.count += 1
+        self.distinct.add(value)
+        if not isinstance(value, numbers.Real) or isinstance(value, bool):
+            return
+        self.numeric_count += 1
+        self.quantiles.add(value)
+        if self.numeric_count == 1:
+            self.mean = float(value)
+            self.min = value
+            self.max = value
+        else:
+            delta = value - self.mean
+            self.mean += delta / self.numeric_count
+            self.__m2 += delta * (value - self.mean)
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+        s = self.__sum + value
+        if abs(self.__sum) >= abs(value):
+            self.__compensation += (self.__sum - s) + value
+        else:
+            self.__compensation += (value - s) + self.__sum
+        self.__sum = s
+
+    def add(self, value):
+        """Adds a single data value"""
+        with self.lock:
+            self.__add(value)
+        return self
+
+    def update(self, datapoints):
+        """Adds the data of all datapoints in the given list, DatapointArray or iterable"""
+        with self.lock:
+            for dp in datapoints:
+                self.__add(dp["d"])
+        return self
+
+    def __call__(self, stream, datapoints):
+        """Adds the datapoints given to a subscription callback"""
+        self.update(datapoints)
+
+    def merge(self, other):
+        """Adds the statistics of another Statistics object to this one"""
+        with self.lock:
+            self.count += other.count
+            self.distinct.merge(other.distinct)
+            if other.numeric_count == 0:
+                return self
+            self.quantiles.merge(other.quantiles)
+            if self.numeric_count == 0:
+                self.mean = other.mean
+                self.min = other.min
+                self.max = other.max
+                self.__m2 = other.__m2
+            else:
+                n = self.numeric_count + other.numeric_count
+                delta = other.mean - self.mean
+                self.__m2 += other.__m2 + delta * delta * self.numeric_count * other.numeric_count / n
+                self.mean += delta * other.numeric_count / n
+                self.min = min(self.min, other.min)
+                self.max = max(self.max, other.max)
+            self.numeric_count += other.numeric_count
+            self.__sum += other.__sum
+            self.__compensation += other.__compensation
+        return self
+
+    @property
+    def sum(self):
+        """The sum of the numeric data"""
+        if self.__compensation == 0:
+            return self.__sum
+        return self.__sum + self.__compensation
+
+    @property
+    def variance(self):
+        """The population variance of the numeric data, or None if there is no numeric data"""
+        if self.numeric_count == 0:
+            return None
+        return self.__m2 / self.numeric_count
+
+    @property
+    def stddev(self):
+        """The population standard deviation of the numeric data, or None if there is no numeric data"""
+        if self.numeric_count == 0:
+            return None
+        return math.sqrt(self.variance)
+
+    def quantile(self, q):
+        """Returns the approximate q-quantile (0 <= q <= 1) of the numeric data, such as quantile(0.5) for the median"""
+        return self.quantiles.quantile(q)
+
+    def distinct_count(self):
+        """Returns the approximate number of distinct data values"""
+        return self.distinct.count()
+
+    def __repr__(self):
+        return "Statistics(count=%i, mean=%s, stddev=%s, min=%s, max=%s)" % (self.count, self.mean, self.stddev,
+                                                                            self.min, self.max)
@@ -1,9 +1,18 @@
 from __future__ import absolute_import
+import collections
 import json
+import logging
 import os
+import struct
+import threading
 
 from ._connectorobject import ConnectorObject
 from ._datapointarray import DatapointArray
+from ._downsample import DOWNSAMPLERS
+from ._writer import StreamWriter
+from ._lazy import LazyQuery
+from ._batching import DATAPOINT_INSERT_LIMIT
+from ._connection import AuthenticationError, ServerError, PayloadTooLargeError
 
 from jsonschema import Draft4Validator
 import json
@@ -15,7 +24,122 @@ try:
 except NameError:
     basestring = (str, bytes)
 
-DATAPOINT_INSERT_LIMIT = 5000
+# The number of datapoints read per request when iterating through a stream in chunks
+DATAPOINT_READ_LIMIT = 20000
+
+# The number of previews cached on each Stream object
+PREVIEW_CACHE_SIZE = 32
+
+
+def _after(t):
+    """Returns the smallest float larger than t, so that a query with t1=t and t2=_after(t) gives exactly
+    the datapoints with timestamp t"""
+    if t == 0:
+        return 5e-324
+    bits = struct.unpack("<q", struct.pack("<d", t))[0]
+    return struct.unpack("<d", struct.pack("<q", bits + 1 if t > 0 else bits - 1))[0]
+
+
+class InsertRequest(threading.Thread):
+    """Sends a batch of datapoints to a stream in the background, so that the next batch
+    can be prepared while the request is in flight. Calling wait() blocks until the request
+    is done, and raises any error that happened while sending it.
+
+    When websocket inserts are enabled on the connection, restamped batches go thru the websocket
+    while it is connected.
+
+    If the server rejects the batch as too large, it is split in half, and both halves are sent in order.
+    If the server rejects the batch as invalid and onreject is given, the batch is bisected to find the invalid
+    datapoints, which are passed to onreject, while all valid datapoints are inserted.
+    Once the whole batch was handled, onbatch is called with the batch's datapoints."""
+
+    def __init__(self, db, path, chunk, body, restamp, onreject=None, onbatch=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db = db
+        self.path = path
+        self.chunk = chunk
+        self.body = body
+        self.restamp = restamp
+        self.onreject = onreject
+        self.onbatch = onbatch
+        self.error = None
+
+    def run(self):
+        try:
+            self.send(self.chunk, self.body)
+            if self.onbatch is not None:
+                self.onbatch(self.chunk)
+        except Exception as e:
+            self.error = e
+
+    def send(self, chunk, body):
+        # Websocket inserts are not acknowledged, so they are only used when errors and
+        # acknowledgements don't need to be handled
+        usews = self.restamp and self.onreject is None and self.onbatch is None and self.db.wsinsert_enabled
+        if usews and self.db.ws.insertraw(self.path, body):
+            return
+        starttime = time.time()
+        try:
+            self.db.insert(self.path + "/data", body, self.restamp)
+        except PayloadTooLargeError:
+            if len(chunk) == 1:
+                raise
+            self.db.batcher.rejected(len(body))
+            self.bisect(chunk)
+            return
+        except (AuthenticationError, ServerError) as e:
+            # A 400 means that the datapoints were invalid (such as schema or timestamp order violations)
+            if self.onreject is None or e.code != 400:
+                raise
+            if len(chunk) == 1:
+                logging.debug("%s: datapoint rejected: %s", self.path, str(e))
+                self.onreject(chunk[0], e)
+                return
+            self.bisect(chunk)
+            return
+        self.db.batcher.sent(len(chunk), len(body), time.time() - starttime)
+
+    def bisect(self, chunk):
+        """Sends both halves of the chunk in order"""
+        half = len(chunk) // 2
+        for c in (chunk[:half], chunk[half:]):
+            for subchunk, subbody in self.db.batcher.encode(c):
+                self.send(subchunk, subbody)
+
+    def wait(self):
+        if self.ident is not None:
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def insert_batches(db, path, datapoints, restamp=False, onreject=None, onbatch=None):
+    """Inserts the given iterable of datapoints into the stream at the given path. This is the implementation
+    of Stream.insert_array, with the additional onbatch callback, which is called in order with the datapoints
+    of each batch once the batch was inserted."""
+    # The datapoints are split into batches sized by the connection's InsertBatcher, so that they fit
+    # in the insert size limit of ConnectorDB. Each batch is encoded while the previous one is
+    # being sent, but a batch is only sent once the previous one succeeded, since streams are append-only.
+    batcher = db.batcher
+    if isinstance(datapoints, list) and len(datapoints) <= batcher.count():
+        # A single batch gains nothing from being sent in the background
+        for chunk, body in batcher.chunks(datapoints):
+            request = InsertRequest(db, path, chunk, body, restamp, onreject, onbatch)
+            request.run()
+            request.wait()
+        return
+
+    request = None
+    try:
+        for chunk, body in batcher.chunks(datapoints):
+            if request is not None:
+                request.wait()
+            request = InsertRequest(db, path, chunk, body, restamp, onreject, onbatch)
+            request.start()
+    finally:
+        if request is not None:
+            request.wait()
 
 
 def query_maker(t1=None, t2=None, limit=None, i1=None, i2=None, transform=None, downlink=False):
@@ -68,8 +192,8 @@ class Stream(ConnectorObject):
         kwargs["schema"] = strschema
         self.metadata = self.db.create(self.path, kwargs).json()
 
-    def insert_array(self, datapoint_array, restamp=False):
-        """given an array of datapoints, inserts them to the stream. This is different from insert(),
+    def insert_array(self, datapoint_array, restamp=False, onreject=None):
+        """given an array (or any other iterable) of datapoints, inserts them to the stream. This is different from insert(),
         because it requires an array of valid datapoints, whereas insert only requires the data portion
         of the datapoint, and fills out the rest::
 
@@ -86,26 +210,18 @@ class Stream(ConnectorObject):
         with timestamps below the datapoints already in the database will have their timestamps overwritten
         to the same timestamp as the most recent datapoint hat already exists in the database, and the insert will
         succeed.
-        """
 
-        # To be safe, we split into chunks
-        while (len(datapoint_array) > DATAPOINT_INSERT_LIMIT):
-            # We insert datapoints in chunks of a couple thousand so that they
-            # fit in the insert size limit of ConnectorDB
-            a = datapoint_array[:DATAPOINT_INSERT_LIMIT]
+        Normally, a single invalid datapoint makes the entire insert fail. When given the optional `onreject` callback,
+        rejected batches are instead split in half repeatedly to find the invalid datapoints. Each invalid datapoint
+        is passed to onreject along with the error, and all other datapoints are inserted::
 
-            if restamp:
-                self.db.update(self.path + "/data", a)
-            else:
-                self.db.create(self.path + "/data", a)
+            rejected = []
+            s.insert_array(datapoints, onreject=lambda dp, err: rejected.append(dp))
 
-            # Clear the written datapoints
-            datapoint_array = datapoint_array[DATAPOINT_INSERT_LIMIT:]
+        Finding k invalid datapoints in a batch of n takes about k*log(n) extra requests.
+        """
 
-        if restamp:
-            self.db.update(self.path + "/data", datapoint_array)
-        else:
-            self.db.create(self.path + "/data", datapoint_array)
+        insert_batches(self.db, self.path, datapoint_array, restamp, onreject)
 
     def insert(self, data):
         """insert inserts one datapoint with the given data, and appends it to
@@ -124,6 +240,19 @@ class Stream(ConnectorObject):
         """ Same as insert, using the pythonic array name """
         self.insert(data)
 
+    def writer(self, max_batch=1000, max_delay=1.0, max_queue=100000, onerror=None):
+        """Returns a StreamWriter, which buffers inserted data in memory, and inserts it into the stream
+        in batches from a background thread. This allows logging at rates where a request per datapoint
+        would be too slow::
+
+            with s.writer(max_delay=0.5) as w:
+                for value in sensor_readings():
+                    w.insert(value)
+
+        Like insert, the datapoints are timestamped with the time they were given to the writer.
+        """
+        return StreamWriter(self, max_batch, max_delay, max_queue, onerror)
+
     def subscribe(self, callback, transform="", downlink=False):
         """Subscribes to the stream, running the callback function each time datapoints are inserted into
         the given stream. There is an optional transform to the datapoints, and a downlink parameter.::
@@ -159,6 +288,30 @@ class Stream(ConnectorObject):
 
         return self.db.subscribe(streampath, callback, transform)
 
+    def subscribe_async(self, transform="", downlink=False, maxsize=0):
+        """Returns an AsyncSubscription, an asyncio iterator over the datapoints inserted into the stream,
+        which runs on the event loop rather than calling a callback from the websocket thread::
+
+            async for data in s.subscribe_async(transform="if $ > 50"):
+                await handle(data)
+
+        Downlink datapoints are acknowledged with the subscription's acknowledge method::
+
+            async with s.subscribe_async(downlink=True, transform="if last") as sub:
+                async for data in sub:
+                    await set_light(data[-1]["d"])
+                    await sub.acknowledge()
+
+        The subscription's queue holds at most maxsize messages if given, dropping the oldest ones.
+        Requires python 3.5+ and the websockets package.
+        """
+        from ._asyncws import AsyncSubscription
+        streampath = self.path
+        if downlink:
+            streampath += "/downlink"
+
+        return AsyncSubscription(self.db.wsasync(), streampath, transform, maxsize)
+
     def unsubscribe(self, transform="", downlink=False):
         """Unsubscribes from a previously subscribed stream. Note that the same values of transform
         and downlink must be passed in order to do the correct unsubscribe::
@@ -184,6 +337,10 @@ class Stream(ConnectorObject):
             stream(transform="sum | if last")
 
         """
+        return DatapointArray(self.__read(t1, t2, limit, i1, i2, downlink, transform))
+
+    def __read(self, t1, t2, limit, i1, i2, downlink, transform):
+        """Reads the datapoints of the query, returning the decoded list of datapoints"""
         params = query_maker(t1, t2, limit, i1, i2, transform, downlink)
 
         # In order to avoid accidental requests for full streams, ConnectorDB does not permit requests
@@ -192,7 +349,33 @@ class Stream(ConnectorObject):
         if len(params) == 0:
             params["i1"] = 0
 
-        return DatapointArray(self.db.read(self.path + "/data", params).json())
+        return self.db.read(self.path + "/data", params).json()
+
+    def columnar(self, t1=None, t2=None, limit=None, i1=None, i2=None, downlink=False, paths=None):
+        """Queries the stream just like calling it, but returns a ColumnarDatapointArray. For streams of JSON
+        objects, the stream's schema is used to flatten the data into a typed column for each property
+        (including properties of nested objects), rather than a dict per datapoint. Only the properties
+        in paths are kept, if given::
+
+            # The schema has {"properties": {"lat": {"type": "number"}, "lon": {"type": "number"}, ...}}
+            c = stream.columnar(t1=time.time() - 3600, paths=["lat", "lon"])
+            print(c["lat"].mean())
+
+        Requires numpy.
+        """
+        from .columnar import ColumnarDatapointArray
+        return ColumnarDatapointArray(self.__read(t1, t2, limit, i1, i2, downlink, None), schema=self.schema,
+                                      paths=paths)
+
+    def lazy(self, downlink=False):
+        """Returns a LazyQuery of the stream's datapoints, which builds up a query step by step, and only
+        reads the datapoints once they are used. As much of the query as possible is run by ConnectorDB::
+
+            # Reads only the datapoints above 50, and shifts their timestamps by a minute locally
+            q = stream.lazy().tslice(time.time() - 3600).where("$ > 50").tshift(60)
+            print(q.collect())
+        """
+        return LazyQuery(self, downlink)
 
     def __getitem__(self, getrange):
         """Allows accessing the stream just as if it were just one big python array.
@@ -214,6 +397,184 @@ class Stream(ConnectorObject):
         # The query is a slice - return the range
         return self(i1=getrange.start, i2=getrange.stop)
 
+    def chunks(self, t1=None, t2=None, i1=None, i2=None, downlink=False, chunksize=DATAPOINT_READ_LIMIT,
+               transform=None):
+        """Iterates through the given range of the stream, returning DatapointArrays of at most
+        chunksize datapoints each. This allows processing streams far larger than would fit in memory,
+        since only one chunk is held at a time::
+
+            total = 0
+            for chunk in stream.chunks(t1=time.time()-60*60*24*365):
+                total += chunk.sum()
+
+        The range is given either by index or by timestamp, just like when calling the stream.
+
+        A transform which works on each datapoint separately, such as "if $ > 50" or "$("temperature")",
+        can be given to run it on the server, so that only its results are downloaded. Transforms that depend
+        on previous datapoints (such as sum) would be restarted for each chunk, so they give wrong results.
+        """
+        if t1 is not None or t2 is not None:
+            if i1 is not None or i2 is not None:
+                raise AssertionError(
+                    "Stream cannot be accessed both by index and by timestamp at the same time.")
+            if transform is None:
+                chunks = self.__timechunks(t1, t2, downlink, chunksize)
+            else:
+                chunks = self.__filteredtimechunks(t1, t2, downlink, chunksize, transform)
+            for chunk in chunks:
+                yield chunk
+            return
+
+        # The index range is fixed at the time of the call - datapoints inserted after
+        # the iteration starts are not returned
+        length = self.length(downlink)
+        i1 = 0 if i1 is None else i1
+        i2 = length if i2 is None or i2 == 0 else i2
+        if i1 < 0:
+            i1 = max(0, length + i1)
+        if i2 < 0:
+            i2 = length + i2
+        i2 = min(i2, length)
+
+        while i1 < i2:
+            iend = min(i1 + chunksize, i2)
+            chunk = self(i1=i1, i2=iend, downlink=downlink, transform=transform)
+            if transform is not None:
+                # The transform can remove any number of the chunk's datapoints
+                if len(chunk) > 0:
+                    yield chunk
+                i1 = iend
+                continue
+            if len(chunk) == 0:
+                return
+            yield chunk
+            i1 += len(chunk)
+
+    def map_reduce(self, mapper, reducer, t1=None, t2=None, i1=None, i2=None, downlink=False, workers=None,
+                   chunksize=DATAPOINT_READ_LIMIT):
+        """Reads the given range of the stream in chunks (see chunks), running mapper on each chunk in a pool
+        of worker processes while the next chunks are read, and combining the results in order with reducer.
+        See DatapointArray.map_reduce::
+
+            def hot_hours(chunk):
+                return set(int(dp["t"] // 3600) for dp in chunk if dp["d"] > 80)
+
+            hours = stream.map_reduce(hot_hours, set.union, t1=time.time() - 60*60*24*365)
+        """
+        from ._mapreduce import map_reduce_chunks
+        return map_reduce_chunks(self.chunks(t1, t2, i1, i2, downlink, chunksize), mapper, reducer, workers)
+
+    def __timechunks(self, t1, t2, downlink, chunksize):
+        """Reads a time range in chunks. Each chunk starts at the timestamp of the last datapoint of the
+        previous one, so the datapoints sharing that timestamp which were already returned are skipped."""
+        seen = 0
+        while True:
+            chunk = self(t1=t1, t2=t2, limit=chunksize, downlink=downlink)
+            full = len(chunk) >= chunksize
+
+            start = 0
+            while start < len(chunk) and start < seen and chunk[start]["t"] == t1:
+                start += 1
+            if start == len(chunk):
+                if not full:
+                    return
+                # More than chunksize datapoints share the timestamp t1, so the rest of them are paged
+                # through separately, and reading continues after the timestamp
+                for chunk in self.__timestampchunks(t1, seen, downlink, chunksize):
+                    yield chunk
+                t1 = _after(t1)
+                seen = 0
+                continue
+
+            if start > 0:
+                chunk = DatapointArray(chunk.raw()[start:])
+            yield chunk
+
+            if not full:
+                return
+            # Count the datapoints at the final timestamp, which will be returned again by the next read
+            last = chunk[-1]["t"]
+            seen = start if last == t1 else 0
+            for dp in reversed(chunk.raw()):
+                if dp["t"] != last:
+                    break
+                seen += 1
+            t1 = last
+
+    def __filteredtimechunks(self, t1, t2, downlink, chunksize, transform):
+        """Reads a time range in chunks, running a transform which works on each datapoint separately.
+        Each chunk ends at the timestamp of the last of the next chunksize datapoints, which is read on its own
+        with the "if last" transform, so that only the datapoints passing the transform are downloaded."""
+        while True:
+            end = self(t1=t1, t2=t2, limit=chunksize, downlink=downlink, transform="if last")
+            if len(end) == 0:
+                return
+            tend = end[-1]["t"]
+            if tend == t1:
+                # All of the next datapoints share the timestamp t1
+                chunks = self.__timestampchunks(t1, 0, downlink, chunksize, transform)
+                tend = _after(t1)
+            else:
+                chunks = [self(t1=t1, t2=tend, downlink=downlink, transform=transform)]
+            for chunk in chunks:
+                if len(chunk) > 0:
+                    yield chunk
+            t1 = tend
+
+    def __timestampchunks(self, t, skip, downlink, chunksize, transform=None):
+        """Reads the datapoints with timestamp t in chunks, skipping the first skip of them. ConnectorDB can't
+        query by both timestamp and index, so each chunk is picked out of the timestamp's datapoints by count."""
+        while True:
+            script = "if count > %i and count <= %i" % (skip, skip + chunksize)
+            if transform is not None:
+                script = transform + " | " + script
+            chunk = self(t1=t, t2=_after(t), downlink=downlink, transform=script)
+            if len(chunk) > 0:
+                yield chunk
+            if len(chunk) < chunksize:
+                return
+            skip += chunksize
+
+    def preview(self, t1, t2, points=2000, method="lttb", downlink=False):
+        """Returns a downsampled version of the given time range, with at most the given number of datapoints.
+        This is useful for plotting - a year of data from a stream can be displayed on a ~2000 pixel wide
+        plot without reading tens of millions of datapoints into memory::
+
+            # Downsample the past year of data
+            dpa = stream.preview(time.time() - 60*60*24*365, time.time(), points=2000)
+
+        The data is read in chunks, and is reduced as it is read. Two methods are supported:
+
+        lttb
+            Largest-Triangle-Three-Buckets, which chooses the visually most representative datapoints
+        minmax
+            returns the smallest and largest datapoints of each time bucket, which keeps all spikes
+
+        The data portion of the stream must be numeric. Since streams are append-only,
+        previews of ranges which are fully in the past are cached on the Stream object
+        (the PREVIEW_CACHE_SIZE most recently used ones).
+        """
+        if method not in DOWNSAMPLERS:
+            raise ValueError("Unknown downsampling method '%s'" % (method, ))
+        key = (t1, t2, points, method, downlink)
+        cache = self.__dict__.setdefault("_previewcache", collections.OrderedDict())
+        if key in cache:
+            cached = cache.pop(key)
+            cache[key] = cached
+            # The datapoints are copied, so that changing the result (such as with tshift) leaves the cache intact
+            return DatapointArray([dict(dp) for dp in cached])
+
+        ds = DOWNSAMPLERS[method](t1, t2, points)
+        for chunk in self.chunks(t1=t1, t2=t2, downlink=downlink):
+            ds.add(chunk.raw())
+        result = ds.result()
+
+        if t2 < time.time():
+            cache[key] = [dict(dp) for dp in result.raw()]
+            while len(cache) > PREVIEW_CACHE_SIZE:
+                cache.popitem(last=False)
+        return result
+
     def length(self, downlink=False):
         return int(self.db.read(self.path + "/data", {"q": "length", "downlink": downlink}).text)
 
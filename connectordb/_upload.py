@@ -0,0 +1,177 @@
+from __future__ import absolute_import
+
+import itertools
+import json
+import logging
+import os
+import threading
+
+from ._stream import insert_batches
+
+
+def _matches(dp, current, restamp):
+    """Returns whether the datapoint of the upload is the given datapoint of the stream. With restamp,
+    the server can change the timestamps, so only the data is compared."""
+    return dp["d"] == current["d"] and (restamp or dp["t"] == current["t"])
+
+
+class UploadSession(object):
+    """UploadSession makes large uploads resumable. As batches of datapoints are acknowledged by the server,
+    the session records each stream's progress in a small local checkpoint file. If the upload is interrupted
+    (by a crash or a lost connection), running the same upload again with the same checkpoint file
+    skips the datapoints that were already inserted, rather than starting over::
+
+        session = connectordb.UploadSession("backfill.checkpoint")
+        session.insert_array(cdb["mystream"], load_all_datapoints())
+
+    This matters in particular with restamp=False, where re-sending datapoints that were already
+    inserted fails, since their timestamps are not after the stream's most recent datapoint.
+
+    Before resuming, the checkpoint is checked against the stream's length and the last datapoint it inserted,
+    and a ValueError is raised if they don't match. The checkpoint also records how many datapoints were
+    rejected (see the onreject argument of Stream.insert_array), so that rejected datapoints are not resent. The datapoints must be given in the same order
+    every time the upload is run.
+    """
+
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+        self.lock = threading.Lock()
+
+        # The checkpoint holds for each stream path (with "/downlink" appended for downlink uploads) the number
+        # of datapoints of the input which were handled ("index"), how many of them were inserted ("inserted")
+        # and rejected ("rejected"), the stream's length once they were inserted ("length"), and the last
+        # inserted datapoint ("last") along with its index in the input ("lastindex").
+        self.checkpoints = {}
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, "r") as f:
+                self.checkpoints = json.load(f)
+
+    def __key(self, stream, downlink):
+        return stream.path + "/downlink" if downlink else stream.path
+
+    def progress(self, stream, downlink=False):
+        """Returns the number of datapoints of the input which were already handled for the given stream"""
+        with self.lock:
+            cp = self.checkpoints.get(self.__key(stream, downlink))
+            if cp is not None:
+                return cp["index"]
+        return 0
+
+    def started(self, stream, downlink=False):
+        """Returns whether an upload to the given stream was started with this session"""
+        with self.lock:
+            return self.__key(stream, downlink) in self.checkpoints
+
+    def __save(self):
+        # Write to a temporary file first, so that a crash while writing does not corrupt the checkpoint
+        tmpfile = self.checkpoint_file + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(self.checkpoints, f)
+        if hasattr(os, "replace"):
+            os.replace(tmpfile, self.checkpoint_file)
+        else:
+            if os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+            os.rename(tmpfile, self.checkpoint_file)
+
+    def __resume(self, stream, downlink, restamp):
+        """Checks the checkpoint against the stream, and returns it, along with the datapoints which were
+        inserted into the stream after the checkpoint was saved"""
+        key = self.__key(stream, downlink)
+        length = stream.length(downlink)
+        with self.lock:
+            cp = self.checkpoints.get(key)
+            if cp is None:
+                cp = {"index": 0, "inserted": 0, "rejected": 0, "length": length, "last": None, "lastindex": None}
+                self.checkpoints[key] = cp
+                self.__save()
+                return dict(cp), []
+            cp = dict(cp)
+
+        if length < cp["length"]:
+            raise ValueError("The stream %s has fewer datapoints than recorded in the checkpoint" % (key, ))
+        if cp["last"] is None and length == cp["length"]:
+            return cp, []
+
+        # The last inserted datapoint is read along with any datapoints inserted after it
+        i1 = cp["length"] - 1 if cp["last"] is not None else cp["length"]
+        current = stream(i1=i1, i2=length, downlink=downlink).raw()
+        if cp["last"] is not None:
+            if not _matches(cp["last"], current[0], restamp):
+                raise ValueError("The checkpoint does not match the datapoints of %s" % (key, ))
+            current = current[1:]
+        return cp, current
+
+    def insert_array(self, stream, datapoints, restamp=False, onreject=None, downlink=False):
+        """Inserts the given list or iterable of datapoints into the stream, just like Stream.insert_array,
+        resuming from the checkpoint if the upload was already (partially) done. With downlink, the upload
+        is checked against the stream's downlink datapoints, for inserts which go to the downlink stream."""
+        key = self.__key(stream, downlink)
+        cp, unrecorded = self.__resume(stream, downlink, restamp)
+        remaining = iter(datapoints)
+
+        if cp["index"] > 0:
+            logging.info("%s: resuming upload at datapoint %i", key, cp["index"])
+            skipped = 0
+            for dp in itertools.islice(remaining, cp["index"]):
+                if skipped == cp["lastindex"] and not _matches(dp, cp["last"], restamp):
+                    raise ValueError("The checkpoint does not match the datapoints of the upload to %s" % (key, ))
+                skipped += 1
+            if skipped < cp["index"]:
+                raise ValueError("The stream %s has more datapoints than the upload" % (key, ))
+
+        if len(unrecorded) > 0:
+            # Batches that were inserted right before an interruption might not have made it into the checkpoint.
+            # The input datapoints which are missing from the stream were rejected.
+            logging.debug("%s: %i datapoints were inserted after the last checkpoint", key, len(unrecorded))
+            handled = []
+            missing = set()
+            for dp in remaining:
+                handled.append(dp)
+                if _matches(dp, unrecorded[len(handled) - len(missing) - 1], restamp):
+                    if len(handled) - len(missing) == len(unrecorded):
+                        break
+                else:
+                    missing.add(id(dp))
+            if len(handled) - len(missing) < len(unrecorded):
+                raise ValueError("The stream %s has datapoints which are not part of the upload" % (key, ))
+            self.__record(key, handled, missing)
+
+        rejected = []
+
+        def reject(dp, err):
+            rejected.append(dp)
+            onreject(dp, err)
+
+        def onbatch(chunk):
+            ids = set(id(dp) for dp in rejected)
+            del rejected[:]
+            self.__record(key, chunk, ids)
+
+        insert_batches(stream.db, stream.path, remaining, restamp,
+                       reject if onreject is not None else None, onbatch)
+
+    def __record(self, key, handled, rejected):
+        """Records that the given datapoints of the input were handled. The ids of the datapoints which
+        were rejected are in the set rejected, and all others were inserted."""
+        with self.lock:
+            cp = self.checkpoints[key]
+            for dp in handled:
+                if id(dp) in rejected:
+                    cp["rejected"] += 1
+                else:
+                    cp["inserted"] += 1
+                    cp["length"] += 1
+                    cp["last"] = {"t": dp["t"], "d": dp["d"]}
+                    cp["lastindex"] = cp["index"]
+                cp["index"] += 1
+            self.__save()
+
+    def clear(self, stream=None):
+        """Removes the checkpoint of the given stream, or of all streams if no stream is given"""
+        with self.lock:
+            if stream is None:
+                self.checkpoints = {}
+            elif stream.path in self.checkpoints:
+                del self.checkpoints[stream.path]
+            self.__save()
@@ -5,7 +5,91 @@ import threading
 import logging
 import json
 import random
+import socket
 import time
+import collections
+
+
+class _Dispatcher(object):
+    """_Dispatcher runs subscription callbacks in a pool of worker threads. The messages of each subscription
+    are queued separately and handled in order, one at a time, while different subscriptions run in parallel.
+    put never waits, so that the websocket's thread keeps handling pings however slow the callbacks are.
+    Instead, at most max_queue calls wait for each subscription (unless max_queue is 0), and once there are more,
+    the oldest waiting call is dropped, as in AsyncSubscription. The number of dropped calls is kept in dropped."""
+
+    def __init__(self, workers, max_queue=1000):
+        self.pending = {}  # The queued calls of each subscription key, starting with the one being run
+        self.ready = collections.deque()  # Subscription keys with queued calls that no worker is running
+        self.active = set()  # Subscription keys whose first call is being run by a worker
+        self.condition = threading.Condition()
+        self.running = True
+        self.accepting = True
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self.__work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def put(self, key, fnc, *args):
+        """Queues the call fnc(*args) after all previously queued calls with the same key. Returns False
+        without queueing the call if the dispatcher is stopping."""
+        with self.condition:
+            if not self.accepting:
+                return False
+            if key not in self.pending:
+                self.pending[key] = collections.deque([(fnc, args)])
+                self.ready.append(key)
+                self.condition.notify_all()
+                return True
+            # The call waits for the ones already queued for this key
+            calls = self.pending[key]
+            running = 1 if key in self.active else 0
+            if self.max_queue > 0 and len(calls) - running >= self.max_queue:
+                logging.warning("ConnectorDB:WS: subscription to %s is full - dropping the oldest message", key)
+                del calls[running]
+                self.dropped += 1
+            calls.append((fnc, args))
+            return True
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.ready) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                key = self.ready.popleft()
+                self.active.add(key)
+                fnc, args = self.pending[key][0]
+            try:
+                fnc(*args)
+            except Exception:
+                logging.exception("ConnectorDB:WS: Subscription callback failed")
+            with self.condition:
+                self.active.discard(key)
+                calls = self.pending[key]
+                calls.popleft()
+                if len(calls) == 0:
+                    del self.pending[key]
+                else:
+                    # Give the other subscriptions a turn before the next call of this one
+                    self.ready.append(key)
+                # Wakes up the other workers, and stop waiting for the queues to empty
+                self.condition.notify_all()
+
+    def stop(self, drain=True):
+        """Stops the workers. No more calls are accepted. With drain, the already queued calls are run first,
+        and stop blocks until they are done (so it must not be called from a callback). Otherwise, the queued
+        calls are dropped."""
+        with self.condition:
+            self.accepting = False
+            while drain and len(self.pending) > 0:
+                self.condition.wait()
+            self.running = False
+            self.condition.notify_all()
 
 
 class WebsocketHandler(object):
@@ -66,6 +150,36 @@ class WebsocketHandler(object):
         self.connected_time = 0
         self.disconnected_time = 0
 
+        # When persistent, the websocket stays connected even without subscriptions (used for inserts)
+        self.persistent = False
+
+        # The server does not acknowledge inserts made through the websocket, but it does send back
+        # error messages. The most recent errors are kept, and onerror is called with each error message.
+        self.inserts_sent = 0
+        self.errors = collections.deque(maxlen=100)
+        self.onerror = None
+
+        # By default, subscription callbacks run on the websocket's thread. See dispatch.
+        self.dispatcher = None
+
+    def dispatch(self, workers=4, max_queue=1000):
+        """Runs subscription callbacks in a pool of the given number of worker threads, so that the websocket's
+        thread only decodes messages. A slow callback then no longer holds up the other subscriptions or
+        the handling of pings. The callbacks of each subscription (stream and transform) are still called
+        one at a time, in the order of the messages, but callbacks of different subscriptions run in parallel.
+        With 0 workers, callbacks run on the websocket's thread again.
+
+        At most max_queue messages wait for each subscription's callback (0 allows any number). Once there are more,
+        the oldest waiting message is dropped with a warning, since the websocket's thread never waits for callbacks.
+
+        The messages that were already queued are handled before the dispatcher is changed, so this must not be
+        called from a subscription callback. Messages arriving meanwhile are handled on the websocket's thread."""
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+            self.dispatcher = None
+        if workers > 0:
+            self.dispatcher = _Dispatcher(workers, max_queue)
+
     def setauth(self,basic_auth):
         """ setauth can be used during runtime to make sure that authentication is reset.
         it can be used when changing passwords/apikeys to make sure reconnects succeed """
@@ -100,13 +214,31 @@ class WebsocketHandler(object):
 
     def send(self, cmd):
         """Send the given command thru the websocket"""
+        self.sendraw(json.dumps(cmd))
+
+    def sendraw(self, msg):
+        """Send the given already json-encoded message thru the websocket"""
         with self.ws_sendlock:
-            self.ws.send(json.dumps(cmd))
+            self.ws.send(msg)
 
     def insert(self, stream, data):
         """Insert the given datapoints into the stream"""
         self.send({"cmd": "insert", "arg": stream, "d": data})
 
+    def insertraw(self, stream, body):
+        """Insert the given json-encoded array of datapoints into the stream. The insert is only sent
+        if the websocket is connected - returns False if nothing was sent, so that the caller can fall back to http.
+        The server does not acknowledge the insert. Errors come back asynchronously, and are kept in `errors`."""
+        if self.status != "connected":
+            return False
+        try:
+            self.sendraw('{"cmd":"insert","arg":%s,"d":%s}' % (json.dumps(stream), body))
+        except (websocket.WebSocketException, socket.error) as e:
+            logging.debug("ConnectorDB:WS: insert failed: %s", str(e))
+            return False
+        self.inserts_sent += 1
+        return True
+
     def subscribe(self, stream, callback, transform=""):
         """Given a stream, a callback and an optional transform, sets up the subscription"""
         if self.status == "disconnected" or self.status == "disconnecting" or self.status == "connecting":
@@ -132,7 +264,7 @@ class WebsocketHandler(object):
 
         self.subscription_lock.acquire()
         del self.subscriptions[stream + ":" + transform]
-        if len(self.subscriptions) is 0:
+        if len(self.subscriptions) is 0 and not self.persistent:
             self.subscription_lock.release()
             self.disconnect()
         else:
@@ -201,8 +333,8 @@ class WebsocketHandler(object):
         if self.reconnect_time < self.reconnect_time_starting_seconds:
             self.reconnect_time = self.reconnect_time_starting_seconds
 
-        logging.warn("ConnectorDB:WS: Attempting to reconnect in %fs",
-                     self.reconnect_time)
+        logging.warning("ConnectorDB:WS: Attempting to reconnect in %fs",
+                        self.reconnect_time)
 
         self.reconnector = threading.Timer(self.reconnect_time,
                                            self.__reconnect_fnc)
@@ -273,6 +405,13 @@ class WebsocketHandler(object):
     def __on_message(self, ws, msg):
         """This function is called whenever there is a message received from the server"""
         msg = json.loads(msg)
+        if "stream" not in msg:
+            # Messages that don't come from a stream are error messages, such as a failed insert
+            logging.warning("ConnectorDB:WS: Server error: %s", msg)
+            self.errors.append(msg)
+            if self.onerror is not None:
+                self.onerror(msg)
+            return
         logging.debug("ConnectorDB:WS: Msg '%s'", msg["stream"])
 
         # Build the subcription key
@@ -285,24 +424,31 @@ class WebsocketHandler(object):
             subscription_function = self.subscriptions[stream_key]
             self.subscription_lock.release()
 
-            fresult = subscription_function(msg["stream"], msg["data"])
-
-            if fresult is True:
-                # This is a special result - if the subscription function of a downlink returns True,
-                # then the datapoint is acknowledged automatically (ie, reinserted in non-downlink stream)
-                fresult = msg["data"]
-
-            if fresult is not False and fresult is not None and msg["stream"].endswith(
-                    "/downlink") and msg["stream"].count("/") == 3:
-                # If the above conditions are true, it means that the datapoints were from a downlink,
-                # and the subscriber function chooses to acknowledge them, so we reinsert them.
-                self.insert(msg["stream"][:-9], fresult)
+            # A dispatcher that was stopped meanwhile has already handled its queued messages
+            dispatcher = self.dispatcher
+            if dispatcher is None or not dispatcher.put(stream_key, self.__call, subscription_function, msg):
+                self.__call(subscription_function, msg)
         else:
             self.subscription_lock.release()
-            logging.warn(
+            logging.warning(
                 "ConnectorDB:WS: Msg '%s' not subscribed! Subscriptions: %s",
                 msg["stream"], list(self.subscriptions.keys()))
 
+    def __call(self, subscription_function, msg):
+        """Calls the subscription's callback with the message, acknowledging downlink datapoints if requested"""
+        fresult = subscription_function(msg["stream"], msg["data"])
+
+        if fresult is True:
+            # This is a special result - if the subscription function of a downlink returns True,
+            # then the datapoint is acknowledged automatically (ie, reinserted in non-downlink stream)
+            fresult = msg["data"]
+
+        if fresult is not False and fresult is not None and msg["stream"].endswith(
+                "/downlink") and msg["stream"].count("/") == 3:
+            # If the above conditions are true, it means that the datapoints were from a downlink,
+            # and the subscriber function chooses to acknowledge them, so we reinsert them.
+            self.insert(msg["stream"][:-9], fresult)
+
     def __on_ping(self, ws, data):
         """The server periodically sends us websocket ping messages to keep the connection alive. To
         ensure that the connection to the server is still active, we memorize the most recent ping's time
@@ -317,7 +463,7 @@ class WebsocketHandler(object):
 
         logging.debug("ConnectorDB:WS: pingcheck")
         if (time.time() - self.lastpingtime > self.connection_ping_timeout):
-            logging.warn("ConnectorDB:WS: Websocket ping timed out!")
+            logging.warning("ConnectorDB:WS: Websocket ping timed out!")
             if self.ws is not None:
                 self.ws.close()
                 self.__on_close(self.ws)
@@ -331,3 +477,5 @@ class WebsocketHandler(object):
     def __del__(self):
         """Make sure that all threads shut down when needed"""
         self.disconnect()
+        if self.dispatcher is not None:
+            self.dispatcher.stop(drain=False)
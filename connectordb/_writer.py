@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+# python 3 vs 2
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Markers put into the queue to make the writer thread send its batch right away
+_FLUSH = object()
+_CLOSE = object()
+
+
+class StreamWriter(object):
+    """StreamWriter allows inserting datapoints into a stream at a high rate. Rather than sending
+    a request for each datapoint like Stream.insert, the datapoints are timestamped when inserted,
+    and are buffered in memory. A background thread sends them in batches through insert_array,
+    either once max_batch datapoints are waiting, or max_delay seconds after the first one was buffered::
+
+        w = cdb["temperature"].writer(max_batch=500, max_delay=2.0)
+        while running:
+            w.insert(get_temperature())
+        w.close()
+
+    At most max_queue datapoints are buffered. Once the buffer is full, insert blocks until there is
+    room (or raises queue.Full if given a timeout that runs out), so a slow connection slows down the
+    producer rather than using unbounded memory.
+
+    If a batch fails to be inserted, onerror is called with the exception and the list of datapoints that
+    were not inserted. Without an onerror callback, the failure is logged and the datapoints are dropped.
+
+    The writer can also be used as a context manager, in which case it is closed on exit.
+    """
+
+    def __init__(self, stream, max_batch=1000, max_delay=1.0, max_queue=100000, onerror=None):
+        self.stream = stream
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.onerror = onerror
+
+        self.queue = queue.Queue(max_queue)
+        self.closed = False
+        self.closelock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def insert(self, data, timeout=None):
+        """Buffers a datapoint with the given data, timestamped with the current time"""
+        # The check and put are done under closelock, so that no datapoint can be queued after _CLOSE,
+        # where the writer thread would never get to it
+        with self.closelock:
+            if self.closed:
+                raise ValueError("The StreamWriter for %s is closed" % (self.stream.path, ))
+            self.queue.put({"t": time.time(), "d": data}, True, timeout)
+
+    def append(self, data):
+        """ Same as insert, using the pythonic array name """
+        self.insert(data)
+
+    def flush(self):
+        """Sends all buffered datapoints, and blocks until they were inserted"""
+        with self.closelock:
+            if self.closed:
+                return
+            self.queue.put(_FLUSH)
+        self.queue.join()
+
+    def close(self):
+        """Sends all buffered datapoints, and stops the background thread"""
+        with self.closelock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(_CLOSE)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        """Returns the approximate number of buffered datapoints"""
+        return self.queue.qsize()
+
+    def __run(self):
+        """Gathers datapoints from the queue into batches, and inserts them"""
+        while True:
+            batch = []
+            marker = self.queue.get()
+            if marker is not _FLUSH and marker is not _CLOSE:
+                batch.append(marker)
+                marker = None
+                deadline = time.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        dp = self.queue.get(True, remaining)
+                    except queue.Empty:
+                        break
+                    if dp is _FLUSH or dp is _CLOSE:
+                        marker = dp
+                        break
+                    batch.append(dp)
+
+            if len(batch) > 0:
+                self.__send(batch)
+            for _ in range(len(batch) + (marker is not None)):
+                self.queue.task_done()
+            if marker is _CLOSE:
+                return
+
+    def __send(self, batch):
+        try:
+            self.stream.insert_array(batch, restamp=True)
+        except Exception as e:
+            if self.onerror is not None:
+                try:
+                    self.onerror(e, batch)
+                except Exception:
+                    logging.exception("StreamWriter: onerror callback failed")
+            else:
+                logging.warning("StreamWriter: failed to insert %i datapoints into %s: %s",
+                                len(batch), self.stream.path, str(e))
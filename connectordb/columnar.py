@@ -0,0 +1,679 @@
+from __future__ import absolute_import
+
+import datetime
+import json
+import os.path
+import struct
+
+import numpy as np
+import six
+from numpy.lib import recfunctions
+
+from ._datapointarray import DatapointArray, _tshifts
+
+
+# The binary file format starts with this magic string, followed by the length of the json header
+BINARY_MAGIC = b"CDBDPA01"
+# The columns in binary files are aligned to this many bytes
+BINARY_ALIGNMENT = 64
+
+
+def _align(offset):
+    return offset + (-offset % BINARY_ALIGNMENT)
+
+
+def datetime64(timestamps, tz=None):
+    """Converts the given unix timestamps (in seconds) into a numpy datetime64[ns] array of UTC times.
+    The whole and fractional seconds are converted separately, so that no precision is lost."""
+    if tz is not None:
+        raise ValueError("numpy datetime64 arrays have no timezone - they are always UTC")
+    t = np.asarray(timestamps, dtype=np.float64)
+    seconds = np.floor(t)
+    ns = seconds.astype(np.int64) * 1000000000 + np.round((t - seconds) * 1e9).astype(np.int64)
+    return ns.view("datetime64[ns]")
+
+
+def column(values):
+    """Converts the given list of data values into a numpy array. Numbers and booleans get a typed
+    array, and all other data (strings, objects, or mixed types) is held in an object array.
+    Booleans mixed with numbers are also held in an object array, so that they don't turn into numbers."""
+    try:
+        arr = np.array(values)
+        if arr.ndim == 1 and arr.dtype.kind == "b":
+            return arr
+        if arr.ndim == 1 and arr.dtype.kind in "iuf":
+            types = set(map(type, values))
+            if bool not in types and np.bool_ not in types:
+                return arr
+    except ValueError:
+        pass
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    return arr
+
+
+def concatenate(a, b):
+    """Concatenates two data columns. Columns of different types (other than integers and floats)
+    are combined into an object column, so that booleans don't turn into numbers. An empty column
+    takes the type of the other one, and structured columns are concatenated field by field, with
+    the fields that only one of them has missing (NaN) in the other"""
+    if len(a) == 0:
+        return b.copy()
+    if len(b) == 0:
+        return a.copy()
+    numeric = a.dtype.kind in "iuf" and b.dtype.kind in "iuf"
+    if numeric or a.dtype == b.dtype:
+        return np.concatenate((a, b))
+    if a.dtype.names is not None and b.dtype.names is not None:
+        names = list(a.dtype.names) + [name for name in b.dtype.names if name not in a.dtype.names]
+        fields = [(name, concatenate(_field(a, name), _field(b, name))) for name in names]
+        result = np.empty(len(a) + len(b), dtype=[(name, col.dtype) for name, col in fields])
+        for name, col in fields:
+            result[name] = col
+        return result
+    if a.dtype.names is not None or b.dtype.names is not None:
+        return column(records(a) + records(b))
+    return np.concatenate((a.astype(object), b.astype(object)))
+
+
+def _field(dcol, name):
+    """Returns the given field of a structured column, or a column of NaN if it has no such field"""
+    if name in dcol.dtype.names:
+        return dcol[name]
+    return np.full(len(dcol), np.nan)
+
+
+def schema_paths(schema, prefix=""):
+    """Returns a list of (path, type) tuples for the properties of the given JSON schema, with the names
+    of nested object properties joined by ".". A schema that isn't an object with properties gives an empty list."""
+    if not isinstance(schema, dict) or not isinstance(schema.get("properties"), dict):
+        return []
+    paths = []
+    for name in sorted(schema["properties"]):
+        prop = schema["properties"][name]
+        path = name if prefix == "" else prefix + "." + name
+        nested = schema_paths(prop, path)
+        if len(nested) > 0:
+            paths += nested
+            continue
+        t = prop.get("type") if isinstance(prop, dict) else None
+        if isinstance(t, list):
+            t = ([x for x in t if x != "null"] + [None])[0]
+        paths.append((path, t))
+    return paths
+
+
+def _typed(values, t):
+    """Converts a list of property values into a numpy array of the type given by its JSON schema type.
+    Missing numbers are NaN, and other missing values None."""
+    missing = any(v is None for v in values)
+    try:
+        if t == "number" or (t == "integer" and missing):
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        if t == "integer":
+            return np.array(values, dtype=np.int64)
+        if t == "boolean" and not missing and all(isinstance(v, bool) for v in values):
+            return np.array(values, dtype=bool)
+    except (TypeError, ValueError):
+        pass
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    return arr
+
+
+def structured(values, schema, paths=None):
+    """Flattens a list of objects into a numpy structured array, with a typed field for each property of the
+    given JSON schema (see schema_paths). If paths is given, only the properties with those paths are extracted.
+    Each field is a column of the array, so that dcol["location.lat"] is a float64 array of latitudes.
+    Returns None if the schema has no properties."""
+    props = schema_paths(schema)
+    if paths is not None:
+        known = dict(props)
+        for path in paths:
+            if path not in known:
+                raise ValueError("The schema has no property '%s'" % (path, ))
+        props = [(path, known[path]) for path in paths]
+    if len(props) == 0:
+        return None
+
+    fields = []
+    for path, t in props:
+        parts = path.split(".")
+        extracted = []
+        for v in values:
+            for part in parts:
+                v = v.get(part) if isinstance(v, dict) else None
+            extracted.append(v)
+        fields.append((path, _typed(extracted, t)))
+
+    result = np.empty(len(values), dtype=[(str(path), arr.dtype) for path, arr in fields])
+    for path, arr in fields:
+        result[str(path)] = arr
+    return result
+
+
+def records(dcol):
+    """Returns the data column as a list of python values. The rows of structured columns are turned
+    back into objects, leaving out the properties that were missing (NaN)"""
+    if dcol.dtype.names is None:
+        return dcol.tolist()
+    names = dcol.dtype.names
+    result = []
+    for row in dcol.tolist():
+        result.append(_unflatten(dict((k, v) for k, v in zip(names, row) if not (isinstance(v, float) and v != v))))
+    return result
+
+
+def flatten(dcol):
+    """Splits a data column into a list of (name, column) tuples. Columns holding objects are split into
+    a column per key, with the keys of nested objects joined by ".", and None where a datapoint is missing
+    the key. The fields of structured columns are returned without copying them.
+    All other data is returned as a single column named "d"."""
+    if dcol.dtype.names is not None:
+        return [(name, dcol[name]) for name in dcol.dtype.names]
+    columns = []
+    _flatten(dcol, "", columns)
+    return columns
+
+
+def _flatten(values, prefix, columns):
+    keys = []
+    if values.dtype == object:
+        seen = set()
+        for v in values.tolist():
+            if isinstance(v, dict):
+                for k in v:
+                    if k not in seen:
+                        seen.add(k)
+                        keys.append(k)
+    if len(keys) == 0:
+        columns.append((prefix or "d", values))
+        return
+    for k in keys:
+        sub = column([v.get(k) if isinstance(v, dict) else None for v in values.tolist()])
+        _flatten(sub, k if prefix == "" else prefix + "." + k, columns)
+
+
+def _unflatten(record):
+    """Turns a dict with flattened keys back into nested objects"""
+    result = {}
+    for key, value in record.items():
+        parts = str(key).split(".")
+        obj = result
+        for part in parts[:-1]:
+            obj = obj.setdefault(part, {})
+        obj[parts[-1]] = value
+    return result
+
+
+def _seconds(t):
+    """Converts the given timestamps (datetimes, or numbers of seconds) into a float64 array of unix timestamps"""
+    import pandas as pd
+    if getattr(t, "dtype", None) is not None and (t.dtype.kind == "M" or hasattr(t.dtype, "tz")):
+        t = pd.DatetimeIndex(t)
+        if t.tz is not None:
+            t = t.tz_convert("UTC").tz_localize(None)
+        return np.asarray(t, dtype="datetime64[ns]").view(np.int64) / 1e9
+    return np.asarray(t, dtype=np.float64)
+
+
+def _sum(dcol, starts, ends, results):
+    if "sum" not in results:
+        results["sum"] = np.add.reduceat(dcol, starts)
+    return results["sum"]
+
+
+def _count(dcol, starts, ends, results):
+    if "count" not in results:
+        results["count"] = ends - starts
+    return results["count"]
+
+
+def _mean(dcol, starts, ends, results):
+    return _sum(dcol, starts, ends, results) / _count(dcol, starts, ends, results).astype(np.float64)
+
+
+# The aggregations supported by resample. Each gets the data column, the start and end index of each
+# bucket, and the aggregations which were already computed, so that mean can reuse sum and count.
+AGGREGATORS = {
+    "sum": _sum,
+    "count": _count,
+    "mean": _mean,
+    "min": lambda dcol, starts, ends, results: np.minimum.reduceat(dcol, starts),
+    "max": lambda dcol, starts, ends, results: np.maximum.reduceat(dcol, starts),
+    "first": lambda dcol, starts, ends, results: dcol[starts],
+    "last": lambda dcol, starts, ends, results: dcol[ends - 1]
+}
+
+
+def _encode(dcol):
+    """Returns the dtype and the bytes of a data column in a binary file. Object columns are written as offsets,
+    followed by the json encoding of each value, with the dtype "json"."""
+    if dcol.dtype == object:
+        encoded = [json.dumps(d).encode("utf-8") for d in dcol.tolist()]
+        offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return "json", offsets.tobytes() + b"".join(encoded)
+    dcol = dcol.astype(dcol.dtype.newbyteorder("<"))
+    return dcol.dtype.str, dcol.tobytes()
+
+
+def _decode(f, filename, dtype, offset, n, mmap):
+    """Reads a data column written by _encode from the open file"""
+    if dtype == "json":
+        f.seek(offset)
+        offsets = np.frombuffer(f.read(8 * (n + 1)), dtype="<i8")
+        encoded = f.read(int(offsets[-1])) if n > 0 else b""
+        dcol = column([json.loads(encoded[offsets[i]:offsets[i + 1]].decode("utf-8")) for i in range(n)])
+        if n > 0 and dcol.dtype != object:
+            dcol = dcol.astype(object)
+        return dcol
+    if mmap and n > 0:
+        return np.memmap(filename, dtype=dtype, mode="c", offset=offset, shape=(n, ))
+    f.seek(offset)
+    return np.fromfile(f, dtype=dtype, count=n)
+
+
+class ColumnarDatapointArray(object):
+    """ColumnarDatapointArray holds datapoints in two numpy arrays - a float64 array of timestamps,
+    and an array of the data portions, which is typed for numeric streams, and an object array otherwise.
+    A numeric datapoint takes up 16 bytes, rather than a python dict per datapoint, and
+    tshift, sum, mean and slicing are vectorized.
+
+    The columnar array has the same API as DatapointArray. Accessing a single datapoint returns a dict
+    view of the datapoint, created when it is accessed, and iterating returns the datapoints as dicts,
+    so a columnar array can be given directly to Stream.insert_array::
+
+        from connectordb.columnar import ColumnarDatapointArray
+
+        c = ColumnarDatapointArray(stream[:])
+        c.tshift(60)
+        print(c.mean())
+        print(c[5:10].d())
+
+    Slices are numpy views, meaning that they share memory with the original array.
+    Changing a datapoint returned by indexing does not modify the array.
+
+    This module requires numpy.
+    """
+
+    def __init__(self, data=[], t=None, d=None, schema=None, paths=None):
+        """The columnar array is created either from a list of datapoints, or directly from its columns::
+
+            ColumnarDatapointArray([{"t": 1, "d": 2}, {"t": 2, "d": 3}])
+            ColumnarDatapointArray(t=[1, 2], d=[2, 3])
+
+        If a JSON schema (such as stream.schema) of object data is given, the data is flattened
+        into a structured array with a typed column for each property, instead of holding a dict for
+        each datapoint. Only the properties in paths are kept, if given::
+
+            c = ColumnarDatapointArray(stream[:], schema=stream.schema, paths=["lat", "lon"])
+            print(c["lat"].mean())
+        """
+        if t is not None:
+            self.tcol = np.asarray(t, dtype=np.float64)
+            self.dcol = d if isinstance(d, np.ndarray) else column(list(d))
+        else:
+            if isinstance(data, ColumnarDatapointArray):
+                self.tcol = data.tcol.copy()
+                self.dcol = data.dcol.copy()
+                return
+            if not isinstance(data, list):
+                data = list(data)
+            self.tcol = np.fromiter((dp["t"] for dp in data), dtype=np.float64, count=len(data))
+            values = [dp["d"] for dp in data]
+            self.dcol = structured(values, schema, paths) if schema is not None else None
+            if self.dcol is None:
+                self.dcol = column(values)
+        if len(self.tcol) != len(self.dcol):
+            raise ValueError("The timestamp and data columns must have the same length")
+
+    def __len__(self):
+        return len(self.tcol)
+
+    def __iter__(self):
+        for t, d in zip(self.tcol.tolist(), records(self.dcol)):
+            yield {"t": t, "d": d}
+
+    def __getitem__(self, key):
+        if (key == "t"):
+            return self.t()
+        if (key == "d"):
+            return self.d()
+        if isinstance(key, six.string_types):
+            # The column of a property of flattened object data
+            if self.dcol.dtype.names is None or key not in self.dcol.dtype.names:
+                raise KeyError(key)
+            return self.dcol[key]
+        if isinstance(key, slice):
+            return ColumnarDatapointArray(t=self.tcol[key], d=self.dcol[key])
+        if self.dcol.dtype.names is not None:
+            return {"t": self.tcol[key].item(), "d": records(self.dcol[key:key + 1 or None])[0]}
+        d = self.dcol[key]
+        if isinstance(d, np.generic):
+            d = d.item()
+        return {"t": self.tcol[key].item(), "d": d}
+
+    def __add__(self, other):
+        return ColumnarDatapointArray(self).merge(other)
+
+    def __radd__(self, other):
+        return ColumnarDatapointArray(self).merge(other)
+
+    def __repr__(self):
+        return "ColumnarDatapointArray(%i datapoints)" % (len(self), )
+
+    @property
+    def nbytes(self):
+        """The number of bytes used by the columns (not including the objects of object columns)"""
+        return self.tcol.nbytes + self.dcol.nbytes
+
+    def sort(self):
+        """Sorts the datapoints by timestamp. The sort is stable, so datapoints with equal
+        timestamps keep their order"""
+        self.__dict__.pop("_tcache", None)
+        order = np.argsort(self.tcol, kind="mergesort")
+        self.tcol = self.tcol[order]
+        self.dcol = self.dcol[order]
+        return self
+
+    def d(self):
+        """Returns the data portion of the datapoints as a numpy array (without copying)"""
+        return self.dcol
+
+    def columns(self):
+        """Returns the names of the property columns of flattened object data, or an empty list"""
+        return list(self.dcol.dtype.names or [])
+
+    def select(self, paths):
+        """Returns a ColumnarDatapointArray with only the given property columns of flattened object data"""
+        return ColumnarDatapointArray(t=self.tcol, d=recfunctions.repack_fields(self.dcol[list(paths)]))
+
+    def t(self, format="datetime", tz=None):
+        """Returns the timestamp portion of the datapoints. The formats are the same as for
+        DatapointArray.t: a list of datetimes (in local time, or the timezone tz), a datetime64 numpy
+        array of UTC times, or with format="float", the timestamp column itself (without copying).
+        Conversions are cached until the array is modified through its methods, or timestamps are shifted
+        with tshift (slices share the timestamp column of the array they came from)."""
+        if format == "float":
+            return self.tcol
+        key = (format, tz)
+        cache = self.__dict__.get("_tcache")
+        if cache is None or cache[0] != _tshifts[0]:
+            cache = self.__dict__["_tcache"] = (_tshifts[0], {})
+        cache = cache[1]
+        if key not in cache:
+            if format == "datetime":
+                cache[key] = [datetime.datetime.fromtimestamp(t, tz) for t in self.tcol.tolist()]
+            elif format == "datetime64":
+                cache[key] = datetime64(self.tcol, tz)
+            else:
+                raise ValueError("Unknown timestamp format '%s'" % (format, ))
+        return cache[key]
+
+    def tslice(self, t1=None, t2=None):
+        """Returns a view of the datapoints with timestamps in the range t1 <= t < t2, found by binary
+        search. The array must be sorted by timestamp. See DatapointArray.tslice"""
+        i1 = 0 if t1 is None else np.searchsorted(self.tcol, t1, "left")
+        i2 = len(self) if t2 is None else np.searchsorted(self.tcol, t2, "left")
+        return self[i1:max(i1, i2)]
+
+    def at(self, t, method="closest"):
+        """Returns the datapoint before, after or closest to the given time, or None if there is
+        no such datapoint. The array must be sorted by timestamp. See DatapointArray.at"""
+        if method == "before":
+            i = np.searchsorted(self.tcol, t, "right")
+            return self[i - 1] if i > 0 else None
+        if method == "after":
+            i = np.searchsorted(self.tcol, t, "left")
+            return self[i] if i < len(self) else None
+        if method == "closest":
+            before = self.at(t, "before")
+            after = self.at(t, "after")
+            if before is None or (after is not None and after["t"] - t < t - before["t"]):
+                return after
+            return before
+        raise ValueError("Unknown method '%s'" % (method, ))
+
+    def merge(self, array):
+        """Adds the given datapoints (a list of datapoints, a DatapointArray or a ColumnarDatapointArray)
+        to the array, and sorts the result by timestamp"""
+        if not isinstance(array, ColumnarDatapointArray):
+            array = ColumnarDatapointArray(array)
+        self.tcol = np.concatenate((self.tcol, array.tcol))
+        self.dcol = concatenate(self.dcol, array.dcol)
+        return self.sort()
+
+    @staticmethod
+    def merge_many(arrays):
+        """Merges the given arrays of datapoints into a single new ColumnarDatapointArray sorted by timestamp.
+        The columns are concatenated once, and sorted with a stable sort which merges already sorted runs."""
+        arrays = [a if isinstance(a, ColumnarDatapointArray) else ColumnarDatapointArray(a) for a in arrays]
+        if len(arrays) == 0:
+            return ColumnarDatapointArray()
+        dcol = arrays[0].dcol
+        for a in arrays[1:]:
+            dcol = concatenate(dcol, a.dcol)
+        return ColumnarDatapointArray(t=np.concatenate([a.tcol for a in arrays]), d=dcol).sort()
+
+    def resample(self, dt, agg="mean", origin=0.):
+        """Groups the datapoints into time buckets of dt seconds, and aggregates each bucket into a
+        single datapoint, timestamped with the start of its bucket. The buckets start at origin, which is
+        the unix epoch by default, so hourly buckets (dt=3600) start on the hour (UTC)::
+
+            hourly = c.resample(3600, "mean")
+            # A single scan, where the data of each datapoint is a dict {"min": ..., "max": ...}
+            ranges = c.resample(60, ["min", "max"])
+
+        The supported aggregations are mean, sum, min, max, count, first and last. Buckets without
+        datapoints are not included in the result.
+        """
+        aggs = list(agg) if isinstance(agg, (list, tuple)) else [agg]
+        for a in aggs:
+            if a not in AGGREGATORS:
+                raise ValueError("Unknown aggregation '%s'" % (a, ))
+
+        tcol, dcol = self.tcol, self.dcol
+        if len(tcol) > 1 and np.any(tcol[1:] < tcol[:-1]):
+            order = np.argsort(tcol, kind="mergesort")
+            tcol, dcol = tcol[order], dcol[order]
+        if len(tcol) == 0:
+            return ColumnarDatapointArray()
+
+        # The index of each datapoint's bucket, and the start/end indices of each nonempty bucket
+        buckets = np.floor((tcol - origin) / dt)
+        starts = np.concatenate(([0], np.flatnonzero(buckets[1:] != buckets[:-1]) + 1))
+        ends = np.concatenate((starts[1:], [len(tcol)]))
+
+        results = {}
+        for a in aggs:
+            results[a] = AGGREGATORS[a](dcol, starts, ends, results)
+        t = buckets[starts] * dt + origin
+        if len(aggs) == 1:
+            return ColumnarDatapointArray(t=t, d=results[aggs[0]])
+        d = [dict(zip(aggs, row)) for row in zip(*[results[a].tolist() for a in aggs])]
+        return ColumnarDatapointArray(t=t, d=d)
+
+    def writeBinary(self, filename):
+        """Writes the datapoints to the given file in a compact binary format, which can be loaded
+        much faster than JSON with ColumnarDatapointArray.open.
+
+        The file holds a small json header (including whether the datapoints are sorted), the timestamps
+        as a little-endian float64 column, and the data. Numeric and boolean data is written as a typed column,
+        and other data as an array of offsets followed by the json encoding of each datapoint's data.
+        Flattened object data (see the schema argument of the constructor) is written as a column per field.
+        """
+        tcol = self.tcol.astype("<f8")
+        header = {
+            "count": len(self),
+            "sorted": bool(len(tcol) < 2 or np.all(tcol[1:] >= tcol[:-1]))
+        }
+        if self.dcol.dtype.names is not None:
+            columns = [_encode(self.dcol[name]) for name in self.dcol.dtype.names]
+            header["dtype"] = "struct"
+            header["fields"] = [[name, dtype] for name, (dtype, _) in zip(self.dcol.dtype.names, columns)]
+        else:
+            columns = [_encode(self.dcol)]
+            header["dtype"] = columns[0][0]
+
+        # The header holds the offsets of the columns, which depend on the length of the header itself.
+        # The offsets are first computed with room for the header, and it is then written with them.
+        hbytes = json.dumps(header).encode("utf-8")
+        header["toffset"] = _align(len(BINARY_MAGIC) + 4 + len(hbytes) + 128 + 24 * len(columns))
+        offsets = [_align(header["toffset"] + tcol.nbytes)]
+        for _, dbytes in columns[:-1]:
+            offsets.append(_align(offsets[-1] + len(dbytes)))
+        header["doffset"] = offsets[0]
+        if header["dtype"] == "struct":
+            header["offsets"] = offsets
+        hbytes = json.dumps(header).encode("utf-8")
+
+        with open(filename, "wb") as f:
+            f.write(BINARY_MAGIC)
+            f.write(struct.pack("<I", len(hbytes)))
+            f.write(hbytes)
+            f.write(b"\0" * (header["toffset"] - f.tell()))
+            f.write(tcol.tobytes())
+            for offset, (_, dbytes) in zip(offsets, columns):
+                f.write(b"\0" * (offset - f.tell()))
+                f.write(dbytes)
+
+    @staticmethod
+    def open(filename, mmap=True):
+        """Opens a file written by writeBinary. With mmap, the timestamp column and numeric data columns
+        are memory-mapped rather than read, so opening is nearly instant no matter the file size, and only
+        the parts of the file that are accessed (such as a time range) are read from disk.
+        The mapping is copy-on-write: changes to the array (like tshift) are never written to the file.
+
+        Data that isn't numeric is always decoded when the file is opened, and flattened object data is
+        read into a structured array. If the file's datapoints are not sorted by timestamp, they are sorted
+        when opened, which reads the whole file.
+        """
+        with open(filename, "rb") as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError("%s is not a binary datapoint file" % (filename, ))
+            hlen = struct.unpack("<I", f.read(4))[0]
+            header = json.loads(f.read(hlen).decode("utf-8"))
+
+            n = header["count"]
+            if header["dtype"] == "struct":
+                fields = [(name, _decode(f, filename, dtype, offset, n, False))
+                          for (name, dtype), offset in zip(header["fields"], header["offsets"])]
+                dcol = np.empty(n, dtype=[(str(name), col.dtype) for name, col in fields])
+                for name, col in fields:
+                    dcol[str(name)] = col
+            else:
+                dcol = _decode(f, filename, header["dtype"], header["doffset"], n, mmap)
+
+            if not mmap or n == 0:
+                f.seek(header["toffset"])
+                tcol = np.fromfile(f, dtype="<f8", count=n)
+
+        if mmap and n > 0:
+            tcol = np.memmap(filename, dtype="<f8", mode="c", offset=header["toffset"], shape=(n, ))
+
+        c = ColumnarDatapointArray(t=tcol, d=dcol)
+        if not header["sorted"]:
+            c.sort()
+        return c
+
+    def raw(self):
+        """Returns the array as a list of datapoint dicts"""
+        return list(iter(self))
+
+    def datapoints(self):
+        """Returns the datapoints as a DatapointArray"""
+        return DatapointArray(self.raw())
+
+    def to_pandas(self):
+        """Returns the datapoints as a pandas DataFrame, indexed by a DatetimeIndex (in UTC) named "t".
+        Numeric data is a single column "d", built from the data column without copying it, and object data
+        is split into a column per key (see flatten). The names of the flattened columns are kept in
+        df.attrs["connectordb"], so that from_pandas gives back objects even if they have a single key.
+        Requires pandas."""
+        import pandas as pd
+        index = pd.DatetimeIndex(datetime64(self.tcol), name="t").tz_localize("UTC")
+        columns = flatten(self.dcol)
+        df = pd.DataFrame(dict(columns), index=index, columns=[name for name, _ in columns], copy=False)
+        if hasattr(df, "attrs") and (len(columns) != 1 or columns[0][1] is not self.dcol):
+            df.attrs["connectordb"] = {"columns": [name for name, _ in columns]}
+        return df
+
+    def to_arrow(self):
+        """Returns the datapoints as a pyarrow Table, with a UTC timestamp column "t", and the data columns
+        as in to_pandas. Numeric columns are given to arrow without copying them. Requires pyarrow."""
+        import pyarrow as pa
+        columns = flatten(self.dcol)
+        arrays = [pa.array(datetime64(self.tcol), type=pa.timestamp("ns", tz="UTC"))]
+        arrays += [pa.array(c) for _, c in columns]
+        return pa.Table.from_arrays(arrays, names=["t"] + [name for name, _ in columns])
+
+    @staticmethod
+    def from_pandas(df):
+        """Creates a ColumnarDatapointArray from a pandas DataFrame or Series. The timestamps come from
+        the "t" column if there is one, and otherwise from the index, which can be a DatetimeIndex or
+        hold unix timestamps. A Series, or a DataFrame with a single data column, gives the column's values
+        as data, and otherwise the data is an object of the columns, with names containing "." nested,
+        which reverses to_pandas. Frames returned by to_pandas for object data always give objects, using
+        the flattened columns recorded in df.attrs. Requires pandas."""
+        import pandas as pd
+        if isinstance(df, pd.Series):
+            return ColumnarDatapointArray(t=_seconds(df.index), d=df.to_numpy())
+        if "t" in df.columns:
+            t = _seconds(df["t"])
+            df = df.drop(columns="t")
+        else:
+            t = _seconds(df.index)
+        flattened = getattr(df, "attrs", {}).get("connectordb", {}).get("columns")
+        if flattened is not None:
+            df = df[[name for name in flattened if name in df.columns]]
+        elif len(df.columns) == 1:
+            return ColumnarDatapointArray(t=t, d=df[df.columns[0]].to_numpy())
+        d = np.empty(len(df), dtype=object)
+        d[:] = [_unflatten(record) for record in df.to_dict("records")]
+        return ColumnarDatapointArray(t=t, d=d)
+
+    def writeJSON(self, filename):
+        """Writes the data to the given file, in the same format as DatapointArray.writeJSON"""
+        with open(filename, "w") as f:
+            json.dump(self.raw(), f)
+
+    def loadJSON(self, filename):
+        """Adds the data from a JSON file. The file is expected to be in datapoint format"""
+        with open(filename, "r") as f:
+            self.merge(json.load(f))
+        return self
+
+    def loadExport(self, folder):
+        """Adds the data from a ConnectorDB stream export"""
+        return self.loadJSON(os.path.join(folder, "data.json"))
+
+    def map_reduce(self, mapper, reducer, workers=None, chunksize=None, dt=None):
+        """Runs mapper on chunks of the array in a pool of worker processes, combining the results with reducer.
+        See DatapointArray.map_reduce"""
+        from ._mapreduce import map_reduce
+        return map_reduce(self, mapper, reducer, workers, chunksize, dt)
+
+    def transform(self, script):
+        """Runs the given PipeScript transform on the datapoints locally, returning a new ColumnarDatapointArray.
+        See connectordb.pipescript.transform"""
+        from .pipescript import transform
+        return transform(self, script)
+
+    def tshift(self, t):
+        """Shifts all timestamps in the array by the given number of seconds, in-place"""
+        self.__dict__.pop("_tcache", None)
+        _tshifts[0] += 1
+        self.tcol += t
+        return self
+
+    def sum(self):
+        """Gets the sum of the data portions of all datapoints within"""
+        s = self.dcol.sum()
+        if isinstance(s, np.generic):
+            s = s.item()
+        return s
+
+    def mean(self):
+        """Gets the mean of the data portions of all datapoints within"""
+        return self.sum() / float(len(self))
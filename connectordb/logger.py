@@ -9,7 +9,8 @@ import os
 import json
 from jsonschema import validate
 
-from ._connectordb import ConnectorDB, CONNECTORDB_URL, DATAPOINT_INSERT_LIMIT
+from ._connectordb import ConnectorDB, CONNECTORDB_URL
+from ._stream import insert_batches
 
 
 class Logger(object):
@@ -194,10 +195,12 @@ class Logger(object):
                     s = cdb[stream]
 
                     c.execute(
-                        "SELECT * FROM cache WHERE stream=? ORDER BY timestamp ASC;",
+                        "SELECT rowid, timestamp, jsondata FROM cache WHERE stream=? ORDER BY timestamp ASC, rowid ASC;",
                         (stream, ))
+                    rowids = []
                     datapointArray = []
                     for dp in c.fetchall():
+                        rowids.append(dp[0])
                         datapointArray.append(
                             {"t": dp[1],
                              "d": json.loads(dp[2])})
@@ -205,40 +208,28 @@ class Logger(object):
                     # First, check if the data already inserted has newer timestamps,
                     # and in that case, assume that there was an error, and remove the datapoints
                     # with an older timestamp, so that we don't have an error when syncing
+                    skipped = 0
                     if len(s) > 0:
                         newtime = s[-1]["t"]
-                        while (len(datapointArray) > 0 and datapointArray[0]["t"] < newtime):
+                        while (skipped < len(datapointArray) and datapointArray[skipped]["t"] < newtime):
                             logging.debug("Datapoint exists with older timestamp. Removing the datapoint.")
-                            datapointArray = datapointArray[1:]
+                            skipped += 1
+                    self.__uncache(rowids[:skipped])
 
-                    if len(datapointArray) > 0:
+                    if len(datapointArray) > skipped:
                         logging.debug("%s: syncing %i datapoints" %
-                                      (stream, len(datapointArray)))
-
-                        while (len(datapointArray) > DATAPOINT_INSERT_LIMIT):
-                            # We insert datapoints in chunks of a couple
-                            # thousand so that they fit in the insert size
-                            # limit of ConnectorDB
-                            s.insert_array(
-                                datapointArray[:DATAPOINT_INSERT_LIMIT])
-
-                            # Clear the written datapoints
-                            datapointArray = datapointArray[
-                                DATAPOINT_INSERT_LIMIT:]
-
-                            # If there was no error inserting, delete the
-                            # datapoints from the cache
-                            c.execute(
-                                "DELETE FROM cache WHERE stream=? AND timestamp <?",
-                                (stream, datapointArray[0]["t"]))
-
-                        s.insert_array(datapointArray)
-
-                        # If there was no error inserting, delete the
-                        # datapoints from the cache
-                        c.execute(
-                            "DELETE FROM cache WHERE stream=? AND timestamp <=?",
-                            (stream, datapointArray[-1]["t"]))
+                                      (stream, len(datapointArray) - skipped))
+
+                        # insert_batches splits the datapoints into batches sized to fit in
+                        # ConnectorDB's request size limit. Each batch is deleted from the cache as soon
+                        # as it was inserted, so that a sync which fails partway doesn't resend it.
+                        inserted = [skipped]
+
+                        def onbatch(chunk, rowids=rowids, inserted=inserted):
+                            self.__uncache(rowids[inserted[0]:inserted[0] + len(chunk)])
+                            inserted[0] += len(chunk)
+
+                        insert_batches(s.db, s.path, datapointArray[skipped:], onbatch=onbatch)
                 self.lastsynctime = time.time()
 
                 if self.onsync is not None:
@@ -252,6 +243,11 @@ class Logger(object):
             if reraise:
                 raise
 
+    def __uncache(self, rowids):
+        """Deletes the given rows from the cache"""
+        if len(rowids) > 0:
+            self.database.cursor().executemany("DELETE FROM cache WHERE rowid=?", [(r, ) for r in rowids])
+
     def __setsync(self):
         with self.synclock:
             logging.debug("Next sync attempt in " + str(self.syncperiod))
@@ -266,7 +262,7 @@ class Logger(object):
         try:
             self.sync()
         except Exception as e:
-            logging.warn("ConnectorDB sync failed: " + str(e))
+            logging.warning("ConnectorDB sync failed: " + str(e))
         self.__setsync()
 
     def start(self):
@@ -276,7 +272,7 @@ class Logger(object):
 
         with self.synclock:
             if self.syncthread is not None:
-                logging.warn(
+                logging.warning(
                     "Logger: Start called on a syncer that is already running")
                 return
 
@@ -0,0 +1,263 @@
+from __future__ import absolute_import
+
+import re
+
+import numpy as np
+
+from .columnar import ColumnarDatapointArray, column
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<number>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*)|
+    (?P<op>>=|<=|==|!=|[<>+\-*/()|,$])
+    )""", re.VERBOSE)
+
+_COMPARISONS = {
+    ">": np.greater,
+    "<": np.less,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+    "==": np.equal,
+    "!=": np.not_equal
+}
+
+_ARITHMETIC = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide
+}
+
+
+def _numeric(d, name):
+    if d.dtype.kind not in "biuf":
+        raise ValueError("The '%s' transform requires numeric data" % (name, ))
+    return d
+
+
+def _last(t, d):
+    result = np.zeros(len(d), dtype=bool)
+    result[-1:] = True
+    return result
+
+
+def _first(t, d):
+    result = np.zeros(len(d), dtype=bool)
+    result[:1] = True
+    return result
+
+
+# The stateful transforms which can be used in expressions. Each gets the timestamp and data columns of
+# the datapoints reaching it, and returns its value at each datapoint - sum is the running sum, so that
+# the last datapoint holds the sum of all of them.
+FUNCTIONS = {
+    "sum": lambda t, d: np.cumsum(_numeric(d, "sum")),
+    "count": lambda t, d: np.arange(1, len(d) + 1),
+    "mean": lambda t, d: np.cumsum(_numeric(d, "mean")) / np.arange(1, len(d) + 1, dtype=np.float64),
+    "last": _last,
+    "first": _first
+}
+
+
+def _property(d, key):
+    """Returns the column of the given property of object data, which is a field of flattened data"""
+    if d.dtype.names is not None:
+        return d[key]
+    return column([dp[key] for dp in d.tolist()])
+
+
+def _tokenize(script):
+    tokens = []
+    pos = 0
+    script = script.rstrip()
+    while pos < len(script):
+        m = _TOKEN.match(script, pos)
+        if m is None:
+            raise ValueError("Invalid PipeScript at position %i: '%s'" % (pos, script))
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "number":
+            value = float(value) if ("." in value or "e" in value.lower()) else int(value)
+        elif kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        tokens.append((kind, value))
+    return tokens
+
+
+class _Parser(object):
+    """A recursive descent parser, which turns a script into a list of stages. Each stage is a function
+    taking the timestamp and data columns, and returning the new timestamp and data columns."""
+
+    def __init__(self, script):
+        self.script = script
+        self.tokens = _tokenize(script)
+        self.pos = 0
+
+    def peek(self, value=None):
+        if self.pos >= len(self.tokens):
+            return None
+        tok = self.tokens[self.pos]
+        if value is not None and (tok[0] not in ("op", "name") or tok[1] != value):
+            return None
+        return tok
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            raise ValueError("Unexpected end of PipeScript '%s'" % (self.script, ))
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def expect(self, value):
+        tok = self.next()
+        if tok[1] != value:
+            raise ValueError("Expected '%s' but got '%s' in PipeScript '%s'" % (value, tok[1], self.script))
+
+    def pipeline(self):
+        stages = [self.stage()]
+        while self.peek("|") is not None:
+            self.next()
+            stages.append(self.stage())
+        if self.peek() is not None:
+            raise ValueError("Unexpected '%s' in PipeScript '%s'" % (self.peek()[1], self.script))
+        return stages
+
+    def stage(self):
+        if self.peek("if") is not None:
+            self.next()
+            cond = self.expr()
+
+            def filter_stage(t, d):
+                keep = np.broadcast_to(np.asarray(cond(t, d)), (len(t), )).astype(bool)
+                return t[keep], d[keep]
+            return filter_stage
+
+        if self.peek("tshift") is not None:
+            self.next()
+            shift = self.expr()
+            return lambda t, d: (t + shift(t, d), d)
+
+        value = self.expr()
+
+        def map_stage(t, d):
+            result = value(t, d)
+            if np.ndim(result) == 0:
+                result = column([result] * len(t)) if len(t) > 0 else d[:0]
+            return t, result
+        return map_stage
+
+    def expr(self):
+        left = self.and_expr()
+        while self.peek("or") is not None:
+            self.next()
+            left = self.__binary(np.logical_or, left, self.and_expr())
+        return left
+
+    def and_expr(self):
+        left = self.not_expr()
+        while self.peek("and") is not None:
+            self.next()
+            left = self.__binary(np.logical_and, left, self.not_expr())
+        return left
+
+    def not_expr(self):
+        if self.peek("not") is not None:
+            self.next()
+            value = self.not_expr()
+            return lambda t, d: np.logical_not(value(t, d))
+        return self.comparison()
+
+    def comparison(self):
+        left = self.sum_expr()
+        tok = self.peek()
+        if tok is not None and tok[0] == "op" and tok[1] in _COMPARISONS:
+            self.next()
+            left = self.__binary(_COMPARISONS[tok[1]], left, self.sum_expr())
+        return left
+
+    def sum_expr(self):
+        left = self.term()
+        while self.peek("+") is not None or self.peek("-") is not None:
+            op = self.next()[1]
+            left = self.__binary(_ARITHMETIC[op], left, self.term())
+        return left
+
+    def term(self):
+        left = self.unary()
+        while self.peek("*") is not None or self.peek("/") is not None:
+            op = self.next()[1]
+            left = self.__binary(_ARITHMETIC[op], left, self.unary())
+        return left
+
+    def unary(self):
+        if self.peek("-") is not None:
+            self.next()
+            value = self.unary()
+            return lambda t, d: np.negative(value(t, d))
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.next()
+        if kind in ("number", "string"):
+            return lambda t, d: value
+        if kind == "op" and value == "(":
+            inner = self.expr()
+            self.expect(")")
+            return inner
+        if kind == "op" and value == "$":
+            if self.peek("(") is None:
+                return lambda t, d: d
+            self.next()
+            key = self.next()
+            self.expect(")")
+            if key[0] != "string":
+                raise ValueError("$ must be given a string key in PipeScript '%s'" % (self.script, ))
+            return lambda t, d: _property(d, key[1])
+        if kind == "name":
+            if value == "true" or value == "false":
+                return lambda t, d: value == "true"
+            if value in FUNCTIONS:
+                if self.peek("(") is not None:
+                    self.next()
+                    self.expect(")")
+                return lambda t, d: FUNCTIONS[value](t, d)
+        raise ValueError("'%s' is not supported in PipeScript '%s'" % (value, self.script))
+
+    def __binary(self, op, left, right):
+        return lambda t, d: op(left(t, d), right(t, d))
+
+
+def parse(script):
+    """Parses the given PipeScript, returning a function which runs it on a ColumnarDatapointArray.
+    Parsing once is useful when running the same script on many arrays"""
+    stages = _Parser(script).pipeline()
+
+    def run(array):
+        t, d = array.tcol, array.dcol
+        for stage in stages:
+            t, d = stage(t, d)
+        return ColumnarDatapointArray(t=t, d=d)
+    return run
+
+
+def transform(array, script):
+    """Runs the given PipeScript transform on the datapoints locally, returning a new array of the results.
+    This evaluates the same transforms as the transform parameter of stream queries, without reading
+    the stream from ConnectorDB again, and with each transform vectorized over the whole array::
+
+        data = cdb["temperature"][:]
+        hot = transform(data, "if $ > 80 | count | if last")
+
+    A subset of PipeScript is supported: $ and $("key"), numbers, strings, true and false,
+    arithmetic (+ - * /), comparisons (> < >= <= == !=), and, or, not, parentheses, pipes (|),
+    if filters, tshift(seconds), and the sum, count, mean, first and last transforms.
+    A ValueError is raised for scripts outside of this subset.
+
+    A DatapointArray (or list of datapoints) gives a DatapointArray, and a ColumnarDatapointArray
+    gives a ColumnarDatapointArray. Requires numpy.
+    """
+    run = parse(script)
+    if isinstance(array, ColumnarDatapointArray):
+        return run(array)
+    return run(ColumnarDatapointArray(array)).datapoints()
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from .._stream import Stream, query_maker
+from .._stream import Stream, query_maker, _after
 from .merge import Merge, get_stream
 import six
 
@@ -201,6 +201,103 @@ class Dataset(object):
 
         self.query["dataset"][colname] = streamquery
 
-    def run(self):
-        """Runs the dataset query, and returns the result"""
-        return self.cdb.db.query("dataset", self.query)
+    def run(self, format="json"):
+        """Runs the dataset query, and returns the result. The format can be "json" for the list of rows
+        returned by ConnectorDB, or "pandas" or "arrow" to get the dataset as a DataFrame or Table with
+        a column for each of the dataset's columns (see DatapointArray.to_pandas)"""
+        return _format(self.cdb.db.query("dataset", self.query), format)
+
+    def fetch(self):
+        """Reads the datapoints that the dataset is generated from, returning a dict of each column's datapoints,
+        with the x stream's datapoints under "x" for X-datasets. Columns that were added with their own range
+        (and merges) are read with it. The other columns are read only around the dataset's rows: the datapoints
+        from the start of the first row's interval up to the last row, along with the one datapoint on either side
+        needed by the before, after and closest interpolators. The result can be given to run_local."""
+        data = {}
+        lo, hi = None, None
+        if "dt" in self.query:
+            if "t1" in self.query and "t2" in self.query:
+                lo = self.query["t1"] - self.query["dt"]
+                hi = self.query["t2"]
+                if self.query.get("limit", 0) > 0:
+                    hi = min(hi, self.query["t1"] + self.query["dt"] * (self.query["limit"] - 1))
+        else:
+            data["x"] = self.__read(self.query)
+            if len(data["x"]) > 0:
+                hi = data["x"][-1]["t"]
+                lo = data["x"][0]["t"]
+        for colname, colquery in self.query["dataset"].items():
+            if hi is None or "merge" in colquery or _ranged(colquery):
+                data[colname] = self.__read(colquery)
+            else:
+                # The first row of an X-dataset aggregates all of the datapoints before it
+                unbounded = "dt" not in self.query and colquery.get("interpolator") not in ("before", "after", "closest")
+                data[colname] = self.__readaround(colquery, None if unbounded else lo, hi)
+        return data
+
+    def __readaround(self, query, lo, hi):
+        # Reads the datapoints in [lo, hi], and the last datapoint before lo and first one after hi
+        transform = query.get("transform")
+        queries = [{"t1": _after(hi), "transform": "if first"}]
+        if lo is None:
+            queries.insert(0, {"t2": _after(hi)})
+        else:
+            queries.insert(0, {"t1": lo, "t2": _after(hi)})
+            queries.insert(0, {"t2": lo, "transform": "if last"})
+        datapoints = []
+        for params in queries:
+            params["stream"] = query["stream"]
+            if transform is not None:
+                params["transform"] = transform + " | " + params["transform"] if "transform" in params else transform
+            datapoints += self.cdb.db.query("merge", [params])
+        return datapoints
+
+    def __read(self, query):
+        if "merge" in query:
+            return self.cdb.db.query("merge", query["merge"])
+        # A merge of a single stream reads it with all of the stream query parameters, including the transform
+        params = {}
+        for key in ("stream", "t1", "t2", "limit", "i1", "i2", "transform"):
+            if key in query:
+                params[key] = query[key]
+        return self.cdb.db.query("merge", [params])
+
+    def run_local(self, data=None, format="json"):
+        """Generates the dataset on this machine rather than in ConnectorDB, using vectorized versions of the
+        closest, before, after, sum, average and count interpolators. The data is a dict of datapoints as returned
+        by fetch, and is fetched if not given. Fetching once and running locally allows trying out
+        different interpolators and time ranges without reading the streams again::
+
+            d = Dataset(cdb, t1=time.time()-1000, t2=time.time(), dt=10.)
+            d.addStream("temperature", "average")
+            data = d.fetch()
+            result = d.run_local(data)
+
+            d.query["dataset"]["temperature"]["interpolator"] = "closest"
+            result = d.run_local(data)
+
+        The format is the same as in run. Requires numpy.
+        """
+        from .local import run_dataset
+        if data is None:
+            data = self.fetch()
+        return _format(run_dataset(self.query, data), format)
+
+
+def _ranged(query):
+    """Returns whether a stream query was given its own range, rather than the whole stream"""
+    return any(k in query for k in ("t1", "t2", "limit")) or query.get("i1", 0) != 0 or query.get("i2", 0) != 0
+
+
+def _format(result, format):
+    """Converts the rows of a dataset into the given format"""
+    if format == "json":
+        return result
+    if format not in ("pandas", "arrow"):
+        raise ValueError("Unknown dataset format '%s'" % (format, ))
+    from ..columnar import ColumnarDatapointArray
+    # The server leaves out timestamps of 0
+    for row in result:
+        row.setdefault("t", 0)
+    arr = ColumnarDatapointArray(result)
+    return arr.to_pandas() if format == "pandas" else arr.to_arrow()
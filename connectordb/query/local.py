@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from ..columnar import ColumnarDatapointArray
+
+
+def _values(dcol, idx, valid):
+    """Returns the data at the given indices as a list, with None wherever valid is False"""
+    values = dcol[np.where(valid, idx, 0)].tolist() if len(dcol) > 0 else [None] * len(idx)
+    return [v if ok else None for v, ok in zip(values, valid.tolist())]
+
+
+def _before(tcol, dcol, t, previous):
+    i = np.searchsorted(tcol, t, "right") - 1
+    return _values(dcol, i, i >= 0)
+
+
+def _after(tcol, dcol, t, previous):
+    i = np.searchsorted(tcol, t, "left")
+    return _values(dcol, i, i < len(tcol))
+
+
+def _closest(tcol, dcol, t, previous):
+    after = np.searchsorted(tcol, t, "left")
+    before = np.searchsorted(tcol, t, "right") - 1
+    hasafter = after < len(tcol)
+    hasbefore = before >= 0
+    tafter = tcol[np.where(hasafter, after, 0)] if len(tcol) > 0 else t
+    tbefore = tcol[np.where(hasbefore, before, 0)] if len(tcol) > 0 else t
+    # On equal distance, the datapoint before the timestamp is used, just like ColumnarDatapointArray.at
+    useafter = hasafter & (~hasbefore | (tafter - t < t - tbefore))
+    return _values(dcol, np.where(useafter, after, before), hasafter | hasbefore)
+
+
+def _ranges(tcol, t, previous):
+    return np.searchsorted(tcol, previous, "right"), np.searchsorted(tcol, t, "right")
+
+
+def _cumsum(dcol):
+    if dcol.dtype.kind not in "biuf":
+        raise ValueError("The sum and average interpolators require numeric data")
+    return np.concatenate(([0], np.cumsum(dcol)))
+
+
+def _count(tcol, dcol, t, previous):
+    starts, ends = _ranges(tcol, t, previous)
+    return (ends - starts).tolist()
+
+
+def _sum(tcol, dcol, t, previous):
+    starts, ends = _ranges(tcol, t, previous)
+    csum = _cumsum(dcol)
+    return (csum[ends] - csum[starts]).tolist()
+
+
+def _average(tcol, dcol, t, previous):
+    starts, ends = _ranges(tcol, t, previous)
+    csum = _cumsum(dcol)
+    counts = ends - starts
+    averages = (csum[ends] - csum[starts]) / np.maximum(counts, 1).astype(np.float64)
+    return _values(averages, np.arange(len(t)), counts > 0)
+
+
+# The interpolators that can be run locally. Each gets the timestamp and data columns of the stream,
+# the timestamps of the dataset's rows, and the timestamps of the rows before them. before, after and
+# closest pick a single datapoint for each row, and sum, average and count aggregate the datapoints
+# in the range previous < t <= row's timestamp.
+INTERPOLATORS = {
+    "before": _before,
+    "after": _after,
+    "closest": _closest,
+    "sum": _sum,
+    "average": _average,
+    "count": _count
+}
+
+
+def trange(t1, t2, dt):
+    """Returns the timestamps of a T-dataset's rows: t1, t1+dt, t1+2dt, ... up to and including t2"""
+    if dt <= 0:
+        raise ValueError("The dataset's dt must be positive")
+    # The small epsilon keeps floating point error from dropping t2 itself (such as with t2=0.3, dt=0.1)
+    n = max(0, int(np.floor((t2 - t1) / float(dt) + 1e-9)) + 1)
+    return t1 + dt * np.arange(n, dtype=np.float64)
+
+
+def _row(t, d):
+    """Returns a row of the dataset, leaving out a timestamp of 0 just like ConnectorDB does"""
+    return {"t": t, "d": d} if t != 0 else {"d": d}
+
+
+def run_dataset(query, data):
+    """Generates the dataset described by the given dataset query locally, from already fetched datapoints.
+    data is a dict of each column's datapoints, and for X-datasets, the datapoints of the x stream under "x".
+    The datapoints can be lists, DatapointArrays or ColumnarDatapointArrays, sorted by timestamp.
+
+    The result has the same structure as the result of the query run by ConnectorDB."""
+    if "posttransform" in query:
+        raise ValueError("Datasets with a posttransform can't be run locally")
+    for colname in query["dataset"]:
+        if colname not in data:
+            raise ValueError("No datapoints were given for column '%s'" % (colname, ))
+
+    arrays = {}
+    for colname in data:
+        arr = data[colname]
+        arrays[colname] = arr if isinstance(arr, ColumnarDatapointArray) else ColumnarDatapointArray(arr)
+
+    if "dt" in query:
+        if "t1" not in query or "t2" not in query:
+            raise ValueError("T-datasets need both t1 and t2")
+        t = trange(query["t1"], query["t2"], query["dt"])
+        if "limit" in query and query["limit"] > 0:
+            t = t[:query["limit"]]
+        previous = t - query["dt"]
+        rows = [_row(ti, {}) for ti in t.tolist()]
+    else:
+        if "x" not in arrays:
+            raise ValueError("No datapoints were given for the x stream")
+        x = arrays["x"]
+        t = x.tcol
+        previous = np.concatenate(([-np.inf], t[:-1]))
+        rows = [_row(ti, {"x": xi}) for ti, xi in zip(t.tolist(), x.dcol.tolist())]
+
+    for colname, colquery in query["dataset"].items():
+        interpolator = colquery.get("interpolator", "closest")
+        if interpolator not in INTERPOLATORS:
+            raise ValueError("The interpolator '%s' can't be run locally" % (interpolator, ))
+        arr = arrays[colname]
+        values = INTERPOLATORS[interpolator](arr.tcol, arr.dcol, t, previous)
+        for row, v in zip(rows, values):
+            row["d"][colname] = v
+
+    return rows
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import unittest
+import operator
 import time
 import json
 import logging
@@ -295,6 +296,178 @@ class TestConnectorDB(unittest.TestCase):
         self.assertEqual(False, dp[1]["d"])
         self.assertEqual(True, dp[2]["d"])
 
+    def test_onreject(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+
+        data = [{"t": i, "d": i} for i in range(100)]
+        data[20]["d"] = "hi"
+        data[70]["d"] = "there"
+        self.assertRaises(connectordb.AuthenticationError, s.insert_array, data)
+        self.assertEqual(0, len(s))
+
+        rejected = []
+        s.insert_array(data, onreject=lambda dp, err: rejected.append(dp))
+        self.assertEqual(98, len(s))
+        self.assertEqual(["hi", "there"], [dp["d"] for dp in rejected])
+
+    def test_uploadsession(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+        if os.path.exists("upload.checkpoint"):
+            os.remove("upload.checkpoint")
+
+        data = [{"t": i, "d": i} for i in range(100)]
+
+        # Simulate an upload that was interrupted after the first 60 datapoints
+        s.insert_array(data[:60])
+        session = connectordb.UploadSession("upload.checkpoint")
+        session.checkpoints[s.path] = {"index": 40, "inserted": 40, "rejected": 0, "length": 40,
+                                       "last": {"t": 39, "d": 39}, "lastindex": 39}
+
+        session.insert_array(s, data)
+        self.assertEqual(100, len(s))
+        self.assertEqual(100, connectordb.UploadSession("upload.checkpoint").progress(s))
+
+        # Running the upload again does nothing
+        connectordb.UploadSession("upload.checkpoint").insert_array(s, data)
+        self.assertEqual(100, len(s))
+
+        data[99]["d"] = 5
+        self.assertRaises(ValueError, connectordb.UploadSession(
+            "upload.checkpoint").insert_array, s, data)
+
+        # Rejected datapoints are counted, and not sent again when the upload is resumed
+        s2 = self.usrdb["teststream2"]
+        s2.create({"type": "number"})
+        data[50]["d"] = "hi"
+        rejected = []
+        for i in range(2):
+            connectordb.UploadSession("upload.checkpoint").insert_array(
+                s2, data, onreject=lambda dp, err: rejected.append(dp))
+        self.assertEqual(99, len(s2))
+        self.assertEqual(1, len(rejected))
+        self.assertEqual(1, connectordb.UploadSession("upload.checkpoint").checkpoints[s2.path]["rejected"])
+        os.remove("upload.checkpoint")
+
+    def test_preview(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+
+        # insert_array accepts generators
+        s.insert_array({"t": 1000 + i, "d": i % 7} for i in range(1000))
+        self.assertEqual(1000, sum(b[0] for b in self.usrdb.db.batcher.history))
+
+        self.assertEqual(1000, sum(len(c) for c in s.chunks(chunksize=300)))
+        self.assertEqual(
+            1000, sum(len(c) for c in s.chunks(t1=1000, t2=2000, chunksize=300)))
+
+        for method in ["lttb", "minmax"]:
+            dpa = s.preview(1000, 2000, points=50, method=method)
+            self.assertTrue(len(dpa) <= 50)
+            self.assertEqual(dpa[0]["t"], 1000)
+            self.assertEqual(dpa[-1]["t"], 1999)
+
+            # Changing a cached preview leaves the cache intact
+            dpa.tshift(5)
+            self.assertEqual(s.preview(1000, 2000, points=50, method=method)[0]["t"], 1000)
+
+        # Datapoints sharing a timestamp are all read, even if there are more of them than fit in a chunk
+        s.insert_array([{"t": 3000, "d": i % 7} for i in range(51)])
+        self.assertEqual([20, 20, 11], [len(c) for c in s.chunks(t1=3000, chunksize=20)])
+
+    def test_lazy(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+        s.insert_array([{"t": 1000 + i, "d": i % 7} for i in range(100)])
+
+        q = s.lazy().tslice(1010).where("$ > 3").tshift(5).limit(3)
+        self.assertEqual(q.explain(), {"query": {"t1": 1010, "transform": "if $ > 3"},
+                                       "local": ["tshift", "limit"]})
+        self.assertEqual(q.collect(), [{"t": 1016, "d": 4}, {"t": 1017, "d": 5}, {"t": 1018, "d": 6}])
+
+        q = s.lazy()[10:20].where(lambda dp: dp["d"] == 0)
+        self.assertEqual(q.explain()["local"], ["filter"])
+        self.assertEqual([dp["t"] for dp in q], [1014])
+
+        q = s.lazy().tslice(1000, 1010)
+        self.assertEqual(q.count(), 10)
+        self.assertEqual(q.sum(), 24)
+        self.assertEqual(q.limit(5).sum(), 10)
+
+        # The condition is run on the server for each chunk, and reading stops at the limit
+        self.assertEqual([dp["d"] for dp in s.lazy().where("$ > 4").limit(3)], [5, 6, 5])
+        self.assertEqual([dp["t"] for dp in s.chunks(t1=1090, chunksize=3, transform="if $ > 4")],
+                         [1090, 1096, 1097])
+
+    def test_map_reduce(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+        s.insert_array([{"t": 1000 + i, "d": i} for i in range(1000)])
+
+        self.assertEqual(s.map_reduce(len, operator.add, workers=2, chunksize=300), 1000)
+        self.assertEqual(s.map_reduce(len, operator.add, t1=1500, chunksize=300), 500)
+
+    def test_writer(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+
+        with s.writer(max_batch=40, max_delay=10) as w:
+            for i in range(100):
+                w.insert(i)
+            w.flush()
+            self.assertEqual(100, len(s))
+            w.insert(100)
+        self.assertEqual(101, len(s))
+        self.assertEqual(100, s[-1]["d"])
+        self.assertRaises(ValueError, w.insert, 5)
+
+        errors = []
+        w = s.writer(onerror=lambda err, dps: errors.extend(dps))
+        w.insert("not a number")
+        w.close()
+        self.assertEqual(1, len(errors))
+
+    def test_wsinsert(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+
+        self.assertTrue(self.usrdb.db.wsinsert())
+        s.insert(1)
+        s.insert(2)
+        time.sleep(0.1)
+        self.assertEqual(2, self.usrdb.db.ws.inserts_sent)
+
+        s.insert("not a number")
+        time.sleep(0.1)
+        self.assertEqual(1, len(self.usrdb.db.ws.errors))
+
+        self.usrdb.db.wsinsert(False)
+        s.insert(3)
+        self.assertEqual(3, len(s))
+        self.usrdb.db.wsdisconnect()
+
+    def test_insert_many(self):
+        self.usrdb["s1"].create({"type": "number"})
+        self.usrdb["s2"].create({"type": "string"})
+
+        errors = self.usrdb.insert_many({
+            "s1": [{"t": 1, "d": 1}, {"t": 2, "d": 2}],
+            "s2": [{"t": 1, "d": "hi"}],
+            "nostream": [{"t": 1, "d": 1}]
+        })
+        self.assertEqual(["nostream"], list(errors.keys()))
+        self.assertEqual(2, len(self.usrdb["s1"]))
+        self.assertEqual(1, len(self.usrdb["s2"]))
+
+        errors = self.usrdb.insert_many([("s1", {"t": 3, "d": 3}), ("s2", {"t": 2, "d": 5}),
+                                         ("s1", {"t": 4, "d": 4})])
+        self.assertEqual(["s2"], list(errors.keys()))
+        self.assertEqual(4, self.usrdb["s1"][-1]["d"])
+
+        with self.assertRaises(ValueError):
+            self.usrdb.insert_many({"s1": [{"t": 5, "d": 5}]}, workers=0)
+
     def test_subscribe(self):
         s = self.usrdb["teststream"]
         s.create({"type": "number"})
@@ -356,6 +529,46 @@ class TestConnectorDB(unittest.TestCase):
         time.sleep(0.1)
         self.assertTrue(subs.msg[0]["d"] == 101)
 
+    def test_wsdispatch(self):
+        s = self.usrdb["teststream"]
+        s.create({"type": "number"})
+        s2 = self.usrdb["teststream2"]
+        s2.create({"type": "number"})
+        self.usrdb.db.wsdispatch(2)
+
+        slow = []
+        subs = subscriber()
+
+        def slow_callback(stream, datapoints):
+            time.sleep(0.3)
+            slow.append(datapoints[0]["d"])
+
+        s.subscribe(slow_callback)
+        s2.subscribe(subs.subscribe_callback)
+        time.sleep(0.1)
+
+        s.insert(1)
+        s.insert(2)
+        s2.insert(3)
+        time.sleep(0.1)
+
+        # The slow subscription doesn't hold up the other one
+        self.assertEqual(3, subs.msg[0]["d"])
+        self.assertEqual([], slow)
+
+        time.sleep(0.7)
+        self.assertEqual([1, 2], slow)
+
+        # Queued messages are handled before the dispatcher is changed
+        s.insert(4)
+        s.insert(5)
+        time.sleep(0.1)
+        self.usrdb.db.wsdispatch(0)
+        self.assertEqual([1, 2, 4, 5], slow)
+
+        s.unsubscribe()
+        s2.unsubscribe()
+
     def test_downlink(self):
         mydevice = self.usrdb.user["mydevice"]
 
@@ -398,6 +611,58 @@ class TestConnectorDB(unittest.TestCase):
         self.assertTrue(1, len(s))
         self.assertTrue(2, s.length(True))
 
+    def test_subscribe_async(self):
+        try:
+            import asyncio
+            import websockets
+        except ImportError:
+            self.skipTest("asyncio subscriptions require the websockets package")
+        mydevice = self.usrdb.user["mydevice"]
+        mydevice.create()
+        s = mydevice["mystream"]
+        mdconn = connectordb.ConnectorDB(mydevice.apikey, url=TEST_URL)
+
+        mds = mdconn["mystream"]
+        mds.create({"type": "number"})
+        mds.downlink = True
+
+        loop = asyncio.new_event_loop()
+        sub = mds.subscribe_async(downlink=True)
+        fullsub = s.subscribe_async(transform="if $ > 200")
+        loop.run_until_complete(sub.subscribe())
+        loop.run_until_complete(fullsub.subscribe())
+        time.sleep(0.2)
+
+        s.append(300)
+        data = loop.run_until_complete(asyncio.wait_for(sub.__anext__(), 5))
+        self.assertEqual(300, data[0]["d"])
+        loop.run_until_complete(sub.acknowledge())
+
+        # The acknowledged datapoint is inserted into the stream itself
+        data = loop.run_until_complete(asyncio.wait_for(fullsub.__anext__(), 5))
+        self.assertEqual(300, data[0]["d"])
+        time.sleep(0.1)
+        self.assertEqual(1, len(s))
+
+        loop.run_until_complete(sub.close())
+        loop.run_until_complete(fullsub.close())
+        with self.assertRaises(StopAsyncIteration):
+            loop.run_until_complete(sub.__anext__())
+        self.assertEqual("disconnected", mdconn.db.wsasync().status)
+
+        # Subscriptions left open when a loop ends don't keep the handler on that loop
+        loop.run_until_complete(mds.subscribe_async(downlink=True).subscribe())
+        loop.close()
+        loop = asyncio.new_event_loop()
+        sub = mds.subscribe_async(downlink=True)
+        loop.run_until_complete(sub.subscribe())
+        time.sleep(0.2)
+        s.append(301)
+        data = loop.run_until_complete(asyncio.wait_for(sub.__anext__(), 5))
+        self.assertEqual(301, data[0]["d"])
+        loop.run_until_complete(sub.close())
+        loop.close()
+
     def test_multicreate(self):
         mydevice = self.usrdb.user["mydevice"]
         mydevice.create(streams={
@@ -1,8 +1,29 @@
 from __future__ import absolute_import
 
 import unittest
+import math
+import operator
+import os
+import pickle
+import random
+import tempfile
 
-from connectordb import DatapointArray
+from connectordb import DatapointArray, DatapointSorter, Statistics
+from connectordb.columnar import ColumnarDatapointArray, flatten
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def _values(chunk):
+    return [dp["d"] for dp in chunk]
 
 
 class TestDatapointArray(unittest.TestCase):
@@ -27,5 +48,283 @@ class TestDatapointArray(unittest.TestCase):
         self.assertEqual(d.sum(),53)
         self.assertEqual(d.mean(),53/2.0)
 
+    def test_slice(self):
+        d = DatapointArray([{"t": 2345, "d": 45}, {"t": 2348, "d": 8}, {"t": 2350, "d": 3}])
+        self.assertEqual(d[1:].d(), [8, 3])
+        self.assertTrue(isinstance(d[1:], DatapointArray))
+
+    def test_merge_many(self):
+        a = DatapointArray([{"t": 1, "d": "a1"}, {"t": 3, "d": "a3"}])
+        b = DatapointArray([{"t": 2, "d": "b2"}, {"t": 3, "d": "b3"}])
+        c = [{"t": 0, "d": "c0"}]
+        m = DatapointArray.merge_many([a, b, c])
+        self.assertEqual(m.d(), ["c0", "a1", "b2", "a3", "b3"])
+        self.assertEqual(len(a), 2)
+        self.assertEqual((a + b).d(), ["a1", "b2", "a3", "b3"])
+
+        m = ColumnarDatapointArray.merge_many([a, b.columnar(), c])
+        self.assertEqual(m.d().tolist(), ["c0", "a1", "b2", "a3", "b3"])
+
+    def test_resample(self):
+        d = DatapointArray([{"t": 0, "d": 1}, {"t": 10, "d": 3}, {"t": 59, "d": 2},
+                            {"t": 200, "d": 7}, {"t": 150, "d": 1}])
+        r = d.resample(60, "mean")
+        self.assertEqual(r.d(), [2.0, 1.0, 7.0])
+        self.assertEqual([dp["t"] for dp in r], [0, 120, 180])
+
+        r = d.resample(60, ["count", "min", "max", "last"], origin=30)
+        self.assertEqual(r[0], {"t": -30, "d": {"count": 2, "min": 1, "max": 3, "last": 3}})
+        self.assertEqual(len(r), 3)
+
+    def test_iterjson(self):
+        fname = os.path.join(tempfile.mkdtemp(), "data.json")
+        data = DatapointArray([{"t": i, "d": {"s": "[],{}" * i}} for i in range(250)])
+        data.writeJSON(fname)
+
+        self.assertEqual(list(DatapointArray.iterJSON(fname)), data.raw())
+        chunks = list(DatapointArray.iterJSON(fname, 100))
+        self.assertEqual([len(c) for c in chunks], [100, 100, 50])
+        self.assertEqual(chunks[2][0]["t"], 200)
+        os.remove(fname)
+
+    def test_t(self):
+        d = DatapointArray([{"t": 1500000000.5, "d": 1}, {"t": 1500000001, "d": 2}])
+        t = d.t("datetime64")
+        self.assertEqual(str(t[0]), "2017-07-14T02:40:00.500000000")
+        self.assertTrue(d.t("datetime64") is t)
+        self.assertEqual(d.t("float"), [1500000000.5, 1500000001])
+
+        d.tshift(1)
+        self.assertEqual(str(d.t("datetime64")[1]), "2017-07-14T02:40:02.000000000")
+        d.append({"t": 1500000003, "d": 3})
+        self.assertEqual(len(d.t("datetime64")), 3)
+        self.assertEqual(len(d.t()), 3)
+
+        # Shifting a slice shifts the datapoints of the array it came from
+        d.t("float")
+        d.tslice(1500000002).tshift(10)
+        self.assertEqual(d.t("float"), [1500000001.5, 1500000012, 1500000013])
+        d *= 2
+        self.assertEqual(len(d.t("float")), 6)
+        d.clear()
+        self.assertEqual(d.t("float"), [])
+        d = DatapointArray([{"t": 1500000001.5, "d": 1}, {"t": 1500000003, "d": 3}])
+
+        # Copies hold the same datapoint dicts
+        d.t("float")
+        (d + []).tshift(100)
+        self.assertEqual(d.t("float"), [1500000101.5, 1500000103])
+        d.tshift(-100)
+
+        c = d.columnar()
+        self.assertTrue(c.t("float") is c.tcol)
+        self.assertEqual(str(c.t("datetime64")[0]), "2017-07-14T02:40:01.500000000")
+        # Slices are views of the timestamp column
+        c[0:1].tshift(100)
+        self.assertEqual(str(c.t("datetime64")[0]), "2017-07-14T02:41:41.500000000")
+
+    def test_tslice(self):
+        d = DatapointArray([{"t": t, "d": t * 2} for t in [1, 2, 2, 4, 8]])
+        for a in [d, d.columnar()]:
+            self.assertEqual([dp["t"] for dp in a.tslice(2, 8)], [2, 2, 4])
+            self.assertEqual([dp["t"] for dp in a.tslice(t2=2)], [1])
+            self.assertEqual(len(a.tslice(5, 3)), 0)
+            self.assertEqual(len(a.tslice(3)), 2)
+
+            self.assertEqual(a.at(3, "before")["t"], 2)
+            self.assertEqual(a.at(3, "after")["t"], 4)
+            self.assertEqual(a.at(3)["t"], 2)
+            self.assertEqual(a.at(3.5)["t"], 4)
+            self.assertEqual(a.at(6)["t"], 4)
+            self.assertEqual(a.at(8, "after")["d"], 16)
+            self.assertTrue(a.at(0, "before") is None)
+            self.assertTrue(a.at(9, "after") is None)
+
+    def test_transform(self):
+        d = DatapointArray([{"t": t, "d": t * 2} for t in [1, 2, 3, 4]])
+        self.assertEqual(d.transform("if $ > 3 | sum"), [{"t": 2, "d": 4}, {"t": 3, "d": 10}, {"t": 4, "d": 18}])
+        self.assertEqual(d.transform("sum | if last"), [{"t": 4, "d": 20}])
+        self.assertEqual(d.transform("if $ >= 4 and not $ == 6 | count"), [{"t": 2, "d": 1}, {"t": 4, "d": 2}])
+        self.assertEqual(d.transform("mean")[1]["d"], 3.)
+        self.assertEqual(d.transform("tshift(10) | ($ + 1) / 2")[0], {"t": 11, "d": 1.5})
+        self.assertEqual(d.columnar().transform("if first or last").d().tolist(), [2, 8])
+
+        o = DatapointArray([{"t": 1, "d": {"a": 1, "b": "x"}}, {"t": 2, "d": {"a": 5, "b": "y"}}])
+        self.assertEqual(o.transform('if $("b") != "x" | $("a")'), [{"t": 2, "d": 5}])
+
+        self.assertRaises(ValueError, d.transform, "map($)")
+        self.assertRaises(ValueError, d.transform, "if $ >")
+
+    def test_statistics(self):
+        values = [random.gauss(10, 3) for i in range(20000)]
+        d = DatapointArray([{"t": i, "d": v} for i, v in enumerate(values)])
+
+        s = d[:5000].statistics()
+        s.merge(pickle.loads(pickle.dumps(d[5000:].statistics())))
+        self.assertEqual(s.count, 20000)
+        self.assertAlmostEqual(s.sum, math.fsum(values), 6)
+        self.assertAlmostEqual(s.mean, math.fsum(values) / 20000, 9)
+        mean = math.fsum(values) / 20000
+        self.assertAlmostEqual(s.variance, math.fsum((v - mean)**2 for v in values) / 20000, 6)
+        self.assertEqual(s.min, min(values))
+        self.assertEqual(s.max, max(values))
+        self.assertAlmostEqual(s.quantile(0.5), sorted(values)[10000], delta=0.3)
+        self.assertAlmostEqual(s.quantile(0.9), sorted(values)[18000], delta=0.3)
+        self.assertAlmostEqual(s.distinct_count(), 20000, delta=1000)
+
+        s = Statistics()
+        s("mystream", [{"t": 1, "d": "hi"}, {"t": 2, "d": 3}, {"t": 3, "d": "hi"}])
+        self.assertEqual(s.count, 3)
+        self.assertEqual(s.numeric_count, 1)
+        self.assertEqual(s.sum, 3)
+        self.assertEqual(s.distinct_count(), 2)
+        self.assertEqual(Statistics().quantile(0.5), None)
+
+    def test_sorter(self):
+        tmpdir = tempfile.mkdtemp()
+        fname = os.path.join(tmpdir, "data.json")
+        DatapointArray([{"t": t, "d": t} for t in range(0, 100, 3)]).writeJSON(fname)
+
+        with DatapointSorter(run_size=10, tmpdir=tmpdir) as s:
+            s.add({"t": t, "d": -t - 1} for t in reversed(range(0, 100, 2)))
+            s.addJSON(fname)
+            self.assertEqual(len(s.runs), 8)
+            self.assertEqual(len(s), 84)
+
+            result = list(s)
+            self.assertEqual([dp["t"] for dp in result], sorted(dp["t"] for dp in result))
+            # Datapoints with equal timestamps stay in the order they were added
+            self.assertEqual(result[:3], [{"t": 0, "d": -1}, {"t": 0, "d": 0}, {"t": 2, "d": -3}])
+            self.assertEqual(result[-1], {"t": 99, "d": 99})
+            self.assertEqual([len(c) for c in s.chunks(40)], [40, 40, 4])
+        self.assertEqual(os.listdir(tmpdir), ["data.json"])
+
+    def test_map_reduce(self):
+        d = DatapointArray([{"t": i, "d": i % 10} for i in range(1000)])
+        self.assertEqual(d.map_reduce(len, operator.add, workers=2), 1000)
+        self.assertEqual(d.map_reduce(len, max, workers=2, dt=100), 100)
+        self.assertEqual(d.columnar().map_reduce(_values, operator.add, workers=2, chunksize=300),
+                         [i % 10 for i in range(1000)])
+
+        o = DatapointArray([{"t": i, "d": {"a": i}} for i in range(10)])
+        self.assertEqual(o.map_reduce(_values, operator.add, workers=2, chunksize=3),
+                         [{"a": i} for i in range(10)])
+        self.assertTrue(DatapointArray().map_reduce(len, operator.add) is None)
+
+
+class TestColumnarDatapointArray(unittest.TestCase):
+
+    def test_basics(self):
+        d = DatapointArray([{"t": 2345, "d": 45}, {"t": 2348, "d": 8}]).columnar()
+
+        self.assertEqual(2, len(d))
+        self.assertEqual(d[0]["d"], 45)
+        self.assertEqual(d[1], {"t": 2348, "d": 8})
+        self.assertEqual(list(d), [{"t": 2345, "d": 45}, {"t": 2348, "d": 8}])
+        self.assertEqual(d.nbytes, 32)
+
+        self.assertEqual(len(d["t"]), 2)
+        self.assertEqual(d["d"][1], 8)
+        self.assertEqual(d[1:].raw(), [{"t": 2348, "d": 8}])
+
+    def test_extras(self):
+        d = ColumnarDatapointArray(t=[2345, 2348], d=[45, 8])
+
+        self.assertEqual(d.tshift(4)[0]["t"], 2349)
+        self.assertEqual(d[1]["t"], 2352)
+
+        self.assertEqual(d.sum(), 53)
+        self.assertEqual(d.mean(), 53 / 2.0)
+
+    def test_objects(self):
+        d = ColumnarDatapointArray([{"t": 3, "d": "hi"}, {"t": 1, "d": {"a": 1}}])
+        d.merge([{"t": 2, "d": True}])
+        self.assertEqual(d.d().tolist(), [{"a": 1}, True, "hi"])
+        self.assertEqual(d.datapoints()[1], {"t": 2, "d": True})
+
+        d = ColumnarDatapointArray([{"t": 1, "d": True}, {"t": 2, "d": 3}])
+        self.assertTrue(d[0]["d"] is True)
+        self.assertEqual(d[1]["d"], 3)
+
+    def test_binary(self):
+        fname = os.path.join(tempfile.mkdtemp(), "test.dpa")
+        ColumnarDatapointArray(t=[2, 1, 3], d=[4.5, 3.5, 5.5]).writeBinary(fname)
+        for mmap in [True, False]:
+            d = DatapointArray.open(fname, mmap=mmap)
+            self.assertEqual(d.raw(), [{"t": 1, "d": 3.5}, {"t": 2, "d": 4.5}, {"t": 3, "d": 5.5}])
+        d.tshift(1)
+        self.assertEqual(DatapointArray.open(fname)[0]["t"], 1)
+
+        DatapointArray([{"t": 1, "d": "hi"}, {"t": 2, "d": {"a": 1}}]).writeBinary(fname)
+        self.assertEqual(DatapointArray.open(fname).d().tolist(), ["hi", {"a": 1}])
+        os.remove(fname)
+
+    def test_schema(self):
+        schema = {"type": "object", "properties": {
+            "lat": {"type": "number"}, "name": {"type": "string"},
+            "meta": {"type": "object", "properties": {"acc": {"type": "integer"}}}}}
+        d = DatapointArray([{"t": 1, "d": {"lat": 1.5, "name": "a", "meta": {"acc": 3}}},
+                            {"t": 2, "d": {"lat": 2.5, "name": "b", "meta": {"acc": 4}}}])
+        c = d.columnar(schema)
+        self.assertEqual(c.columns(), ["lat", "meta.acc", "name"])
+        self.assertEqual(c["lat"].dtype.kind, "f")
+        self.assertEqual(c["meta.acc"].tolist(), [3, 4])
+        self.assertEqual(c.datapoints(), d)
+        self.assertEqual(c[-1], d[-1])
+        self.assertEqual(c.select(["name"])[0], {"t": 1, "d": {"name": "a"}})
+        self.assertEqual(c.transform('if $("lat") > 2').raw(), d[1:])
+
+        # Merges and binary files keep the typed fields
+        self.assertEqual((ColumnarDatapointArray() + c).dcol.dtype, c.dcol.dtype)
+        m = c + d.columnar(schema, ["lat"]).tshift(2)
+        self.assertEqual(m.columns(), c.columns())
+        self.assertEqual(m[-1], {"t": 4, "d": {"lat": 2.5}})
+        fname = os.path.join(tempfile.mkdtemp(), "test.dpa")
+        m.writeBinary(fname)
+        for mmap in [True, False]:
+            o = ColumnarDatapointArray.open(fname, mmap=mmap)
+            self.assertEqual(o.dcol.dtype, m.dcol.dtype)
+            self.assertEqual(o.raw(), m.raw())
+        os.remove(fname)
+
+        c = DatapointArray([{"t": 1, "d": {"lat": 1}}, {"t": 2, "d": {"name": "x"}}]).columnar(schema, ["lat"])
+        self.assertEqual(c.columns(), ["lat"])
+        self.assertEqual(c.raw(), [{"t": 1, "d": {"lat": 1}}, {"t": 2, "d": {}}])
+        self.assertRaises(ValueError, d.columnar, schema, ["lon"])
+
+    def test_flatten(self):
+        d = ColumnarDatapointArray([{"t": 1, "d": {"a": 1, "b": {"c": "x"}}}, {"t": 2, "d": {"a": 2, "e": True}}])
+        columns = flatten(d.dcol)
+        self.assertEqual([name for name, _ in columns], ["a", "b.c", "e"])
+        self.assertEqual(columns[0][1].tolist(), [1, 2])
+        self.assertEqual(columns[1][1].tolist(), ["x", None])
+        self.assertEqual(flatten(ColumnarDatapointArray(t=[1], d=[2.5]).dcol)[0][0], "d")
+
+    @unittest.skipIf(pandas is None, "pandas is not installed")
+    def test_pandas(self):
+        d = DatapointArray([{"t": 1500000000.5, "d": 4}, {"t": 1500000001, "d": 5}])
+        df = d.to_pandas()
+        self.assertEqual(df["d"].tolist(), [4, 5])
+        self.assertEqual(str(df.index[0]), "2017-07-14 02:40:00.500000+00:00")
+        self.assertEqual(DatapointArray.from_pandas(df), d)
+
+        o = DatapointArray([{"t": 1, "d": {"a": 1, "b": {"c": 2}}}, {"t": 2, "d": {"a": 3, "b": {"c": 4}}}])
+        df = o.to_pandas()
+        self.assertEqual(list(df.columns), ["a", "b.c"])
+        self.assertEqual(DatapointArray.from_pandas(df), o)
+
+        # Objects with a single key stay objects
+        o = DatapointArray([{"t": 1, "d": {"a": 1}}, {"t": 2, "d": {"a": 3}}])
+        self.assertEqual(DatapointArray.from_pandas(o.to_pandas()), o)
+        c = ColumnarDatapointArray(o, schema={"type": "object", "properties": {"a": {"type": "number"}}})
+        self.assertEqual(DatapointArray.from_pandas(c.to_pandas()), o)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_arrow(self):
+        table = DatapointArray([{"t": 1, "d": {"a": 1}}, {"t": 2, "d": {"a": 3}}]).to_arrow()
+        self.assertEqual(table.column_names, ["t", "a"])
+        self.assertEqual(table.column("a").to_pylist(), [1, 3])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -141,5 +141,99 @@ class TestQuery(unittest.TestCase):
             }
         ])
 
+
+class TestLocalDataset(unittest.TestCase):
+
+    temperature = [{"t": 2, "d": 73}, {"t": 5, "d": 84}, {"t": 8, "d": 81}, {"t": 11, "d": 79}]
+    mood = [{"t": 1, "d": 7}, {"t": 4, "d": 3}, {"t": 11, "d": 5}]
+
+    def test_tdataset(self):
+        ds = Dataset(None, t1=0, t2=8.1, dt=2)
+        ds.addStream("u/d/temperature", "closest", colname="temperature")
+        ds.addStream("u/d/temperature", "sum", colname="sum")
+        ds.addStream("u/d/temperature", "count", colname="count")
+        ds.addStream("u/d/temperature", "average", colname="average")
+        ds.addStream("u/d/temperature", "before", colname="before")
+        ds.addStream("u/d/temperature", "after", colname="after")
+
+        data = {}
+        for colname in ds.query["dataset"]:
+            data[colname] = self.temperature
+        res = ds.run_local(data)
+
+        # Just like ConnectorDB, the row at t=0 has no timestamp
+        self.assertEqual({"d": res[0]["d"]}, res[0])
+        self.assertEqual([0, 2, 4, 6, 8], [r.get("t", 0) for r in res])
+        self.assertEqual([73, 73, 84, 84, 81], [r["d"]["temperature"] for r in res])
+        self.assertEqual([0, 73, 0, 84, 81], [r["d"]["sum"] for r in res])
+        self.assertEqual([0, 1, 0, 1, 1], [r["d"]["count"] for r in res])
+        self.assertEqual([None, 73, None, 84, 81], [r["d"]["average"] for r in res])
+        self.assertEqual([None, 73, 73, 84, 81], [r["d"]["before"] for r in res])
+        self.assertEqual([73, 73, 84, 81, 81], [r["d"]["after"] for r in res])
+
+        self.assertRaises(ValueError, ds.run_local, {"temperature": self.temperature})
+
+        ds.query["posttransform"] = "$"
+        self.assertRaises(ValueError, ds.run_local, data)
+
+    def test_xdataset(self):
+        ds = Dataset(None, "u/d/mood_rating")
+        ds.addStream("u/d/temperature", "closest", colname="temperature")
+        ds.addStream("u/d/temperature", "sum", colname="sum")
+
+        res = ds.run_local({"x": self.mood, "temperature": self.temperature, "sum": self.temperature})
+        self.assertListEqual(res, [
+            {"t": 1, "d": {"temperature": 73, "x": 7, "sum": 0}},
+            {"t": 4, "d": {"temperature": 84, "x": 3, "sum": 73}},
+            {"t": 11, "d": {"temperature": 79, "x": 5, "sum": 244}}
+        ])
+
+        ds.query["dataset"]["sum"]["interpolator"] = "closest"
+        res = ds.run_local({"x": self.mood[:0], "temperature": [], "sum": []})
+        self.assertListEqual(res, [])
+
+    def test_fetch(self):
+        db = _LocalMerge({"u/d/temperature": list(self.temperature), "u/d/mood_rating": self.mood})
+        db.data["u/d/temperature"] += [{"t": 20 + i, "d": 70} for i in range(100)]
+        cdb = type("cdb", (object, ), {"db": db})
+
+        ds = Dataset(cdb, t1=4, t2=8, dt=2)
+        for interpolator in ("closest", "sum", "before", "after"):
+            ds.addStream("u/d/temperature", interpolator, colname=interpolator)
+        data = ds.fetch()
+        self.assertEqual([2, 5, 8, 11], [dp["t"] for dp in data["closest"]])
+        self.assertEqual([2, 5, 8, 11], [dp["t"] for dp in data["sum"]])
+        full = dict((colname, db.data["u/d/temperature"]) for colname in data)
+        self.assertListEqual(ds.run_local(data), ds.run_local(full))
+
+        ds = Dataset(cdb, "u/d/mood_rating")
+        ds.addStream("u/d/temperature", "closest", colname="temperature")
+        ds.addStream("u/d/temperature", "sum", colname="sum")
+        ds.addStream("u/d/temperature", transform="if $ > 80", colname="hot")
+        ds.addStream("u/d/temperature", i1=0, i2=2, colname="ranged")
+        data = ds.fetch()
+        self.assertEqual([2, 5, 8, 11, 20], [dp["t"] for dp in data["temperature"]])
+        self.assertEqual([2, 5, 8, 11, 20], [dp["t"] for dp in data["sum"]])
+        self.assertEqual([5, 8], [dp["t"] for dp in data["hot"]])
+        self.assertEqual([2, 5], [dp["t"] for dp in data["ranged"]])
+
+
+class _LocalMerge(object):
+    """Runs single-stream merge queries on local data, the way ConnectorDB does"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def query(self, kind, params):
+        from connectordb.pipescript import transform
+        params = params[0]
+        dps = self.data[params["stream"]]
+        if "i1" in params:
+            dps = dps[params["i1"]:params["i2"] if params["i2"] != 0 else len(dps)]
+        dps = [dp for dp in dps if params.get("t1", -1e300) <= dp["t"] < params.get("t2", 1e300)]
+        if "transform" in params and len(dps) > 0:
+            dps = [{"t": dp["t"], "d": dp["d"]} for dp in transform(dps, params["transform"])]
+        return dps
+
 if __name__ == "__main__":
     unittest.main()
@@ -22,4 +22,6 @@ setup(name='ConnectorDB',
                       'License :: OSI Approved :: MIT License',
                       'Programming Language :: Python :: 2',
                       'Programming Language :: Python :: 3'],
-      install_requires=["requests", "websocket-client", "jsonschema"])
+      install_requires=["requests", "websocket-client", "jsonschema"],
+      # Stream.subscribe_async runs on asyncio, using the websockets package
+      extras_require={"async": ["websockets"]})